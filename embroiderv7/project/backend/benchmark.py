@@ -0,0 +1,422 @@
+"""
+Benchmarks for the digitization pipeline stages.
+
+Usage:
+    python benchmark.py tracers [image ...] [--repeat N]
+    python benchmark.py batch [image ...] [--count N] [--repeat N]
+    python benchmark.py rdp [--points N ...] [--epsilon E] [--repeat N]
+    python benchmark.py simplifiers [image ...] [--tolerance T ...] [--repeat N]
+    python benchmark.py flatten [image ...] [--tolerance T ...] [--repeat N]
+    python benchmark.py parse [image ...] [--repeat N]
+    python benchmark.py dst [image ...] [--repeat N]
+    python benchmark.py travel [image ...] [--seconds S ...]
+    python benchmark.py fill [image ...] [--spacing S ...] [--repeat N]
+    python benchmark.py satin [image ...] [--spacing S ...] [--repeat N]
+    python benchmark.py running [--contours N ...] [--length L] [--repeat N]
+    python benchmark.py preprocess [image ...] [--sizes N ...] [--long-edge L] [--repeat N]
+    python benchmark.py colors [image ...] [--colors K ...] [--workers N] [--repeat N]
+
+Without images, a synthetic test image is generated.
+"""
+import argparse
+import io
+import math
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import main
+
+
+def synthetic_image(size: int = 1000) -> Path:
+    """Draw a logo-like test image (filled shapes, holes, thin strokes) into a temporary PNG."""
+    rng = np.random.default_rng(0)
+    image = np.full((size, size), 255, np.uint8)
+    for _ in range(40):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        radius = int(rng.integers(size // 60, size // 10))
+        cv2.circle(image, center, radius, 0, -1)
+        cv2.circle(image, center, radius // 3, 255, -1)
+    for _ in range(30):
+        start = tuple(int(v) for v in rng.integers(0, size, 2))
+        end = tuple(int(v) for v in rng.integers(0, size, 2))
+        cv2.line(image, start, end, 0, int(rng.integers(2, 8)))
+    path = Path(tempfile.mkdtemp()) / f"synthetic_{size}.png"
+    cv2.imwrite(str(path), image)
+    return path
+
+
+def synthetic_color_image(size: int = 1000, colors: int = 8) -> Path:
+    """Draw overlapping shapes in `colors` colours on white into a temporary PNG."""
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 200, (colors, 3)).tolist()
+    image = np.full((size, size, 3), 255, np.uint8)
+    for index in range(60):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        radius = int(rng.integers(size // 40, size // 8))
+        cv2.circle(image, center, radius, palette[index % colors], -1)
+    path = Path(tempfile.mkdtemp()) / f"synthetic_color_{size}.png"
+    cv2.imwrite(str(path), image)
+    return path
+
+
+def time_call(func, repeat: int):
+    """Median wall time of func() over repeat runs, and the last result."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def bench_tracers(args):
+    images = [Path(image) for image in args.images] or [synthetic_image()]
+    print(f"{'image':<28} {'backend':<10} {'median ms':>10} {'contours':>9} {'segments':>9}")
+    for image in images:
+        bitmap = main.preprocess_image(image)
+        for name, backend in main.TRACING_BACKENDS.items():
+            try:
+                seconds, (curves, svg) = time_call(lambda: backend.trace(bitmap), args.repeat)
+            except FileNotFoundError:
+                print(f"{image.name:<28} {name:<10} {'not installed':>10}")
+                continue
+            print(f"{image.name:<28} {name:<10} {seconds * 1000:10.1f} {len(curves):9d} {len(curves.controls):9d}")
+
+
+def bench_batch(args):
+    images = [Path(image) for image in args.images] or [synthetic_image(size) for size in (400, 700, 1000)]
+    bitmaps = [main.preprocess_image(image) for image in images]
+    bitmaps = (bitmaps * args.count)[:args.count]
+    print(f"{len(bitmaps)} bitmaps")
+    print(f"{'backend':<10} {'one by one ms':>14} {'batched ms':>11} {'bitmaps/s':>10} {'speedup':>8}")
+    for name, backend in main.TRACING_BACKENDS.items():
+        try:
+            single, _ = time_call(lambda: [backend.trace(bitmap) for bitmap in bitmaps], args.repeat)
+            batched, _ = time_call(lambda: backend.trace_many(bitmaps), args.repeat)
+        except FileNotFoundError:
+            print(f"{name:<10} {'not installed':>14}")
+            continue
+        print(f"{name:<10} {single * 1000:14.1f} {batched * 1000:11.1f} "
+              f"{len(bitmaps) / batched:10.1f} {single / batched:7.2f}x")
+
+
+def reference_rdp(points, epsilon):
+    """The original recursive RDP on complex points, kept to check and time the array version."""
+    def distance(point, start, end):
+        if start == end:
+            return math.hypot(point.real - start.real, point.imag - start.imag)
+        n = abs((end.real - start.real) * (start.imag - point.imag) -
+                (start.real - point.real) * (end.imag - start.imag))
+        return n / math.hypot(end.real - start.real, end.imag - start.imag)
+
+    dmax = 0.0
+    index = 0
+    end = len(points) - 1
+    for i in range(1, end):
+        d = distance(points[i], points[0], points[end])
+        if d > dmax:
+            index = i
+            dmax = d
+    if dmax > epsilon:
+        return reference_rdp(points[:index + 1], epsilon)[:-1] + reference_rdp(points[index:], epsilon)
+    return [points[0], points[end]]
+
+
+def noisy_contour(n: int) -> np.ndarray:
+    """A closed, wobbly contour of n points, like a dense potrace outline."""
+    rng = np.random.default_rng(n)
+    angles = np.linspace(0, 2 * np.pi, n)
+    radius = 2000 + 300 * np.sin(7 * angles) + rng.normal(0, 3, n)
+    return np.column_stack((radius * np.cos(angles), radius * np.sin(angles)))
+
+
+def bench_rdp(args):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    print(f"{'points':>8} {'reference ms':>13} {'array ms':>9} {'speedup':>8} {'kept':>6} {'identical':>10}")
+    for n in args.points:
+        points = noisy_contour(n)
+        complex_points = list(points[:, 0] + 1j * points[:, 1])
+        reference, expected = time_call(lambda: reference_rdp(complex_points, args.epsilon), args.repeat)
+        vectorized, kept = time_call(lambda: main.rdp(points, args.epsilon), args.repeat)
+        identical = np.array_equal(kept[:, 0] + 1j * kept[:, 1], np.array(expected))
+        print(f"{n:8d} {reference * 1000:13.1f} {vectorized * 1000:9.1f} "
+              f"{reference / vectorized:7.1f}x {len(kept):6d} {str(identical):>10}")
+
+
+def bench_simplifiers(args):
+    images = [Path(image) for image in args.images] or [synthetic_image()]
+    corpus = [noisy_contour(n) for n in (1000, 10000, 50000)]
+    for image in images:
+        bitmap = main.preprocess_image(image)
+        for backend in main.TRACING_BACKENDS.values():
+            try:
+                curves, svg = backend.trace(bitmap)
+            except FileNotFoundError:
+                continue
+            corpus.extend(main.flatten_curves(curves, 1.0))
+    print(f"{len(corpus)} contours, {sum(len(points) for points in corpus)} vertices")
+    print(f"{'simplifier':<10} {'tolerance':>9} {'median ms':>10} {'vertices':>9}")
+    for tolerance in args.tolerance:
+        for name, simplify in main.SIMPLIFIERS.items():
+            seconds, simplified = time_call(lambda: [simplify(points, tolerance) for points in corpus], args.repeat)
+            print(f"{name:<10} {tolerance:9.1f} {seconds * 1000:10.1f} {sum(len(points) for points in simplified):9d}")
+
+
+def bench_flatten(args):
+    images = [Path(image) for image in args.images] or [synthetic_image()]
+    print(f"{'image':<28} {'backend':<10} {'tolerance':>9} {'segments':>9} {'median ms':>10} {'points':>8} {'max error':>10}")
+    for image in images:
+        bitmap = main.preprocess_image(image)
+        for name, backend in main.TRACING_BACKENDS.items():
+            try:
+                curves, svg = backend.trace(bitmap)
+            except FileNotFoundError:
+                continue
+            segments = len(curves.controls)
+            # Curve midpoints, B(0.5), to measure the flattening error against
+            midpoints = np.einsum("skd,k->sd", curves.controls, [0.125, 0.375, 0.375, 0.125])
+            for tolerance in args.tolerance:
+                seconds, contours = time_call(lambda: main.flatten_curves(curves, tolerance), args.repeat)
+                # Distance from curve midpoints to the flattened polylines, checked on a sample
+                points = sum(len(contour) for contour in contours)
+                starts = np.concatenate([contour[:-1] for contour in contours])
+                edges = np.concatenate([np.diff(contour, axis=0) for contour in contours])
+                lengths = np.maximum((edges ** 2).sum(axis=1), 1e-12)
+                error = 0.0
+                for midpoint in midpoints[::max(1, segments // 200)]:
+                    t = np.clip(((midpoint - starts) * edges).sum(axis=1) / lengths, 0, 1)
+                    error = max(error, np.hypot(*(starts + edges * t[:, None] - midpoint).T).min())
+                print(f"{image.name:<28} {name:<10} {tolerance:9.1f} {segments:9d} "
+                      f"{seconds * 1000:10.1f} {points:8d} {error:10.2f}")
+
+
+def bench_parse(args):
+    images = [Path(image) for image in args.images] or [synthetic_image(size) for size in (500, 1000, 2000)]
+    print(f"{'image':<28} {'svg KB':>7} {'segments':>9} {'svgpathtools ms':>16} {'streaming ms':>13} {'speedup':>8}")
+    for image in images:
+        try:
+            curves, svg = main.TRACING_BACKENDS["potrace"].trace(main.preprocess_image(image))
+        except FileNotFoundError:
+            print(f"{image.name:<28} potrace not installed")
+            return
+        generic, _ = time_call(lambda: main.parse_svg(svg), args.repeat)
+        streaming, curves = time_call(lambda: main.parse_potrace_svg(svg), args.repeat)
+        print(f"{image.name:<28} {len(svg) / 1024:7.0f} {len(curves.controls):9d} "
+              f"{generic * 1000:16.1f} {streaming * 1000:13.1f} {generic / streaming:7.1f}x")
+
+
+def bench_dst(args):
+    images = [Path(image) for image in args.images] or [synthetic_image(size) for size in (500, 1000, 2000)]
+    print(f"{'image':<28} {'stitches':>9} {'pyembroidery ms':>16} {'numpy ms':>9} {'speedup':>8} {'identical':>10}")
+    for image in images:
+        bitmap = main.preprocess_image(image)
+        try:
+            curves, _ = main.TRACING_BACKENDS["potrace"].trace(bitmap)
+        except FileNotFoundError:
+            curves, _ = main.TRACING_BACKENDS["opencv"].trace(bitmap)
+        plan = main.generate_stitches(curves, {"stitch_density": 2.0})
+
+        def write_pyembroidery():
+            stream = io.BytesIO()
+            main.write_dst(plan.to_pattern(), stream)
+            return stream.getvalue()
+
+        reference, expected = time_call(write_pyembroidery, args.repeat)
+        native, encoded = time_call(lambda: main.encode_dst(plan), args.repeat)
+        print(f"{image.name:<28} {len(plan):9d} {reference * 1000:16.1f} {native * 1000:9.1f} "
+              f"{reference / native:7.1f}x {str(encoded == expected):>10}")
+
+
+def bench_travel(args):
+    images = [Path(image) for image in args.images] or [synthetic_image(size) for size in (500, 1000, 2000)]
+    print(f"{'image':<28} {'contours':>9} {'2-opt s':>8} {'ms':>8} {'travel mm':>10} {'ordered mm':>11} {'saved':>6}")
+    for image in images:
+        bitmap = main.preprocess_image(image)
+        try:
+            curves, _ = main.TRACING_BACKENDS["potrace"].trace(bitmap)
+        except FileNotFoundError:
+            curves, _ = main.TRACING_BACKENDS["opencv"].trace(bitmap)
+        contours = main.flatten_curves(curves, 2.0)
+        plan = main.simplify_paths(contours, tolerance=2.0, max_length=main.MAX_STITCH_LENGTH)
+        for seconds in args.seconds:
+            elapsed, (_, before, after) = time_call(lambda: main.order_contours(plan, seconds), 1)
+            saved = 100 * (1 - after / before) if before else 0.0
+            print(f"{image.name:<28} {len(plan.offsets) - 1:9d} {seconds:8.1f} {elapsed * 1000:8.0f} "
+                  f"{before / 10:10.0f} {after / 10:11.0f} {saved:5.0f}%")
+
+
+def bench_fill(args):
+    images = [Path(image) for image in args.images] or [synthetic_image()]
+    # A large filled region next to the traced images: a 40 cm disc with a hole
+    angles = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+    disc = np.column_stack((np.cos(angles), np.sin(angles)))
+    disc = np.vstack((disc, disc[:1]))
+    regions = {"disc 400 mm": [disc * 2000, disc[::-1] * 600]}
+    for image in images:
+        curves, _ = main.TRACING_BACKENDS["opencv"].trace(main.preprocess_image(image))
+        plan = main.simplify_paths(main.flatten_curves(curves, 2.0), tolerance=2.0, max_length=main.MAX_STITCH_LENGTH)
+        regions[image.name] = list(plan.contours())
+    print(f"{'region':<28} {'spacing':>8} {'median ms':>10} {'stitches':>9} {'blocks':>7} {'stitches/s':>11}")
+    for name, contours in regions.items():
+        for spacing in args.spacing:
+            seconds, plan = time_call(lambda: main.tatami_fill(contours, spacing=spacing), args.repeat)
+            print(f"{name:<28} {spacing:8.1f} {seconds * 1000:10.1f} {len(plan):9d} "
+                  f"{len(plan.offsets) - 1:7d} {len(plan) / seconds:11.0f}")
+
+
+def bench_satin(args):
+    images = [Path(image) for image in args.images] or [synthetic_image()]
+    print(f"{'image':<28} {'spacing':>8} {'median ms':>10} {'outline':>8} {'satin':>8} {'pieces':>7}")
+    for image in images:
+        curves, _ = main.TRACING_BACKENDS["opencv"].trace(main.preprocess_image(image))
+        plan = main.simplify_paths(main.flatten_curves(curves, 2.0), tolerance=2.0, max_length=main.MAX_STITCH_LENGTH)
+        contours = list(plan.contours())
+        for spacing in args.spacing:
+            seconds, satin = time_call(lambda: main.satin_columns(contours, spacing=spacing), args.repeat)
+            print(f"{image.name:<28} {spacing:8.1f} {seconds * 1000:10.1f} {len(plan):8d} {len(satin):8d} "
+                  f"{len(satin.offsets) - 1:7d}")
+
+
+def bench_running(args):
+    # Side by side copies of a dense, wobbly outline
+    outline = noisy_contour(2000)
+    print(f"{'contours':>9} {'points':>9} {'stitches':>9} {'median ms':>10} {'stitches/s':>11}")
+    for count in args.contours:
+        shifts = np.arange(count)[:, None] * [5000, 0]
+        plan = main.StitchPlan.from_contours([outline + shift for shift in shifts])
+        seconds, running = time_call(lambda: main.resample_running(
+            plan, args.length, main.RUNNING_MIN_LENGTH, main.RUNNING_MAX_LENGTH, main.CORNER_ANGLE), args.repeat)
+        print(f"{count:9d} {len(plan):9d} {len(running):9d} {seconds * 1000:10.1f} {len(running) / seconds:11.0f}")
+
+
+def bench_preprocess(args):
+    images = [Path(image) for image in args.images]
+    for size in args.sizes:
+        png = synthetic_image(size)
+        jpeg = png.with_suffix(".jpg")
+        cv2.imwrite(str(jpeg), cv2.imread(str(png)))
+        images += [png, jpeg]
+    print(f"{'image':<28} {'decode ms':>10} {'preprocess ms':>14} {'output':>10}")
+    for image in images:
+        decode, _ = time_call(lambda: main.decode_image(image, args.long_edge), args.repeat)
+        seconds, bitmap = time_call(lambda: main.preprocess_image(image, long_edge=args.long_edge), args.repeat)
+        magic, width, height = bitmap.split(maxsplit=3)[:3]
+        print(f"{image.name:<28} {decode * 1000:10.1f} {seconds * 1000:14.1f} {f'{int(width)}x{int(height)}':>10}")
+
+
+def digitize_layer(bitmap: bytes) -> int:
+    """Trace and fill one colour layer, as the pipeline does in its workers; returns the stitch count."""
+    return len(main.generate_stitches(main.vectorize_image(bitmap, tracer="opencv"), {"stitch_type": "fill"}))
+
+
+def bench_colors(args):
+    images = [Path(image) for image in args.images] or [synthetic_color_image()]
+    print(f"{'image':<28} {'colors':>6} {'layers':>6} {'quantize ms':>12} {'serial ms':>10} "
+          f"{'pool ms':>8} {'speedup':>8} {'stitches':>9}")
+    with ProcessPoolExecutor(args.workers) as pool:
+        list(pool.map(int, range(args.workers)))  # start the workers before timing
+        for image in images:
+            for colors in args.colors:
+                quantize, layers = time_call(lambda: main.quantize_image(image, colors), args.repeat)
+                bitmaps = [bitmap for color, bitmap in layers]
+                serial, counts = time_call(lambda: [digitize_layer(bitmap) for bitmap in bitmaps], args.repeat)
+                parallel, _ = time_call(lambda: list(pool.map(digitize_layer, bitmaps)), args.repeat)
+                print(f"{image.name:<28} {colors:6d} {len(layers):6d} {quantize * 1000:12.1f} {serial * 1000:10.1f} "
+                      f"{parallel * 1000:8.1f} {serial / parallel:7.2f}x {sum(counts):9d}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tracers = commands.add_parser("tracers", help="compare tracing backends: latency and vertex counts")
+    tracers.add_argument("images", nargs="*")
+    tracers.add_argument("--repeat", type=int, default=5)
+    tracers.set_defaults(func=bench_tracers)
+
+    batch = commands.add_parser("batch", help="tracing bitmaps one by one versus batched per backend")
+    batch.add_argument("images", nargs="*")
+    batch.add_argument("--count", type=int, default=32, help="number of bitmaps in the batch")
+    batch.add_argument("--repeat", type=int, default=3)
+    batch.set_defaults(func=bench_batch)
+
+    rdp = commands.add_parser("rdp", help="array RDP versus the original recursive version")
+    rdp.add_argument("--points", type=int, nargs="+", default=[1000, 10000, 50000])
+    rdp.add_argument("--epsilon", type=float, default=2.0)
+    rdp.add_argument("--repeat", type=int, default=3)
+    rdp.set_defaults(func=bench_rdp)
+
+    simplifiers = commands.add_parser("simplifiers", help="time and vertex count of each simplifier")
+    simplifiers.add_argument("images", nargs="*")
+    simplifiers.add_argument("--tolerance", type=float, nargs="+", default=[1.0, 2.0, 5.0])
+    simplifiers.add_argument("--repeat", type=int, default=3)
+    simplifiers.set_defaults(func=bench_simplifiers)
+
+    flatten = commands.add_parser("flatten", help="time, point count and error of curve flattening")
+    flatten.add_argument("images", nargs="*")
+    flatten.add_argument("--tolerance", type=float, nargs="+", default=[0.5, 2.0, 5.0])
+    flatten.add_argument("--repeat", type=int, default=5)
+    flatten.set_defaults(func=bench_flatten)
+
+    parse = commands.add_parser("parse", help="streaming potrace SVG parser versus svgpathtools")
+    parse.add_argument("images", nargs="*")
+    parse.add_argument("--repeat", type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+
+    dst = commands.add_parser("dst", help="numpy DST encoder versus pyembroidery's write_dst")
+    dst.add_argument("images", nargs="*")
+    dst.add_argument("--repeat", type=int, default=3)
+    dst.set_defaults(func=bench_dst)
+
+    travel = commands.add_parser("travel", help="travel between contours before and after ordering")
+    travel.add_argument("images", nargs="*")
+    travel.add_argument("--seconds", type=float, nargs="+", default=[0.0, main.TRAVEL_2OPT_SECONDS, 0.5],
+                        help="2-opt time limits")
+    travel.set_defaults(func=bench_travel)
+
+    fill = commands.add_parser("fill", help="tatami fill throughput in stitches per second")
+    fill.add_argument("images", nargs="*")
+    fill.add_argument("--spacing", type=float, nargs="+", default=[4.0, 8.0], help="row spacing, pattern units")
+    fill.add_argument("--repeat", type=int, default=3)
+    fill.set_defaults(func=bench_fill)
+
+    satin = commands.add_parser("satin", help="satin column generation time and stitch counts")
+    satin.add_argument("images", nargs="*")
+    satin.add_argument("--spacing", type=float, nargs="+", default=[4.0, 6.0], help="rail spacing, pattern units")
+    satin.add_argument("--repeat", type=int, default=3)
+    satin.set_defaults(func=bench_satin)
+
+    running = commands.add_parser("running", help="running stitch resampling, scaling with design size")
+    running.add_argument("--contours", type=int, nargs="+", default=[100, 1000, 5000])
+    running.add_argument("--length", type=float, default=main.RUNNING_STITCH_LENGTH)
+    running.add_argument("--repeat", type=int, default=3)
+    running.set_defaults(func=bench_running)
+
+    preprocess = commands.add_parser("preprocess", help="decode and preprocessing time by image size and format")
+    preprocess.add_argument("images", nargs="*")
+    preprocess.add_argument("--sizes", type=int, nargs="*", default=[1000, 4000])
+    preprocess.add_argument("--long-edge", type=int, default=main.PREPROCESS_PARAMS["long_edge"],
+                            help=f"working resolution; high detail is {main.DETAIL_LEVELS['high']}")
+    preprocess.add_argument("--repeat", type=int, default=3)
+    preprocess.set_defaults(func=bench_preprocess)
+
+    colors = commands.add_parser("colors", help="colour quantization, and layers digitized serially versus in a pool")
+    colors.add_argument("images", nargs="*")
+    colors.add_argument("--colors", type=int, nargs="+", default=[2, 4, 8])
+    colors.add_argument("--workers", type=int, default=main.WORKER_POOL_SIZE)
+    colors.add_argument("--repeat", type=int, default=3)
+    colors.set_defaults(func=bench_colors)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    run()
@@ -2,17 +2,34 @@ import os
 import uuid
 import shutil
 import subprocess
+import functools
+import hashlib
+import heapq
+import io
+import json
+import sqlite3
+import time
+import multiprocessing
+import pickle
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, WebSocket, WebSocketDisconnect, BackgroundTasks, HTTPException
+from fastapi import FastAPI, Request, Header, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel, ValidationError
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 from pyembroidery import *
-from svgpathtools import svg2paths, Path as SvgPath, Line
-from PIL import Image, ImageFilter
+from svgpathtools import svgstr2paths, Line, QuadraticBezier, CubicBezier
+from PIL import Image
+import aiofiles
+import aiofiles.os
 import cv2
 import numpy as np
 import logging
@@ -51,10 +68,17 @@ PROCESSED_DIR = BASE_DIR / "processed"
 OUTPUT_DIR = BASE_DIR / "outputs"
 LOG_DIR = BASE_DIR / "logs"
 DOWNLOAD_DIR = BASE_DIR / "download"
+JOBS_DIR = BASE_DIR / "jobs"
+JOBS_DB = JOBS_DIR / "jobs.db"
+CANCEL_DIR = JOBS_DIR / "cancelled"
+CACHE_DIR = BASE_DIR / "cache"
+RESULT_CACHE_DIR = CACHE_DIR / "results"
+STAGE_CACHE_DIR = CACHE_DIR / "stages"
 
 # Create directories if they don't exist and ensure proper permissions
 def ensure_directories():
-    directories = [UPLOAD_DIR, PROCESSED_DIR, OUTPUT_DIR, LOG_DIR, DOWNLOAD_DIR]
+    directories = [UPLOAD_DIR, PROCESSED_DIR, OUTPUT_DIR, LOG_DIR, DOWNLOAD_DIR, JOBS_DIR, CANCEL_DIR,
+                   CACHE_DIR, RESULT_CACHE_DIR, STAGE_CACHE_DIR]
     for directory in directories:
         directory.mkdir(parents=True, exist_ok=True)
         # Ensure directory has proper permissions (755)
@@ -73,6 +97,132 @@ logging.basicConfig(
     format='%(asctime)s:%(levelname)s:%(message)s'
 )
 
+# Worker pool configuration. The CPU-bound pipeline stages run in separate
+# processes so uploads, downloads and WebSockets stay responsive.
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", os.cpu_count() or 1))
+WORKER_MAX_TASKS_PER_CHILD = int(os.getenv("WORKER_MAX_TASKS_PER_CHILD", "100"))  # 0 = never recycle
+
+# Per-stage timeouts in seconds
+STAGE_TIMEOUTS = {
+    "preprocess": float(os.getenv("PREPROCESS_TIMEOUT", "60")),
+    "vectorize": float(os.getenv("VECTORIZE_TIMEOUT", "120")),
+    "stitches": float(os.getenv("STITCHES_TIMEOUT", "120")),
+    "save": float(os.getenv("SAVE_TIMEOUT", "30")),
+}
+
+# Job queue configuration
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))  # seconds between queue scans
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # give up on jobs that keep killing the server
+
+# Scheduling configuration. Interactive jobs always go before bulk jobs; within a lane,
+# clients (or API keys) share the workers fairly according to their weights.
+LANES = ["interactive", "bulk"]
+MAX_JOBS_PER_CLIENT = int(os.getenv("MAX_JOBS_PER_CLIENT", "2"))
+# Workers kept free of bulk work so interactive uploads never wait behind a batch
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", max(1, WORKER_POOL_SIZE - 1)))
+# Optional per-tenant weights, e.g. {"key:3f2a...": 4}; tenants default to 1
+TENANT_WEIGHTS: Dict[str, float] = json.loads(os.getenv("TENANT_WEIGHTS", "{}"))
+
+# Admission control. Uploads are rejected with 429 once either limit is reached.
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "200"))  # queued jobs
+MAX_INFLIGHT_MEGAPIXELS = float(os.getenv("MAX_INFLIGHT_MEGAPIXELS", "500"))  # queued + running
+READY_SATURATION = float(os.getenv("READY_SATURATION", "0.9"))  # /ready reports busy above this
+# Assumed throughput per stage (megapixels/second) until real timings have been observed
+STAGE_THROUGHPUT_PRIOR = float(os.getenv("STAGE_THROUGHPUT_PRIOR", "2.0"))
+
+# Parameters of the preprocessing stage. They are part of the stage cache keys (as are the
+# tracing backend's), so intermediate results are only reused while these stay the same.
+# The image is scaled so its long edge is long_edge pixels, keeping its aspect ratio.
+PREPROCESS_PARAMS = {"long_edge": 500, "blur_radius": 1, "block_size": 11, "c": 2}
+# Detail levels a request can ask for: the long edge (pixels) the image is traced at, which for
+# high detail is capped at the image's own long edge. Finer traces are scaled down again, so
+# the design keeps the size a standard trace gives it.
+DETAIL_LEVELS = {"standard": PREPROCESS_PARAMS["long_edge"], "high": int(os.getenv("HIGH_DETAIL_LONG_EDGE", "4000"))}
+# Large images are blurred and thresholded in tiles, PREPROCESS_THREADS at a time, keeping the
+# working memory within PREPROCESS_MEMORY_MB (the decoded image itself comes on top of that)
+PREPROCESS_THREADS = int(os.getenv("PREPROCESS_THREADS", min(4, os.cpu_count() or 1)))
+PREPROCESS_MEMORY_MB = float(os.getenv("PREPROCESS_MEMORY_MB", "32"))
+
+# Tracing backend used when a request doesn't choose one: "potrace" or "opencv"
+DEFAULT_TRACER = os.getenv("DEFAULT_TRACER", "potrace")
+# Path simplifier used when a request doesn't choose one: "rdp", "vw" or "radial"
+DEFAULT_SIMPLIFIER = os.getenv("DEFAULT_SIMPLIFIER", "rdp")
+# Pattern units (0.1 mm) per bitmap pixel; 10 keeps the scale Potrace's raw coordinates had
+PATTERN_UNITS_PER_PIXEL = 10
+# Longest stitch the pattern may contain, in pattern units (0.1 mm); longer runs are split
+MAX_STITCH_LENGTH = float(os.getenv("MAX_STITCH_LENGTH", "70"))
+# Batched tracing: bitmaps per potrace invocation, and where its input/output files live
+# (tmpfs by default, so batching doesn't put the bitmaps back on a real disk)
+POTRACE_BATCH_SIZE = int(os.getenv("POTRACE_BATCH_SIZE", "64"))
+TRACE_TMP_DIR = os.getenv("TRACE_TMP_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+# Colour mode: the image is quantized to this many colours, the background included (requests
+# may ask for 2 to MAX_COLORS), with the palette learnt by k-means from about
+# KMEANS_SAMPLE_PIXELS pixels
+COLOR_MODES = ["monochrome", "color"]
+COLOR_COUNT = int(os.getenv("COLOR_COUNT", "4"))
+MAX_COLORS = int(os.getenv("MAX_COLORS", "16"))
+KMEANS_SAMPLE_PIXELS = int(os.getenv("KMEANS_SAMPLE_PIXELS", "20000"))
+# Palette clean-up: colours within COLOR_MERGE_DISTANCE (RGB units) of a more common colour are
+# sewn as that colour, as are blends of two that cover less than MAX_BLEND_FRACTION of the image
+# (the anti-aliased edges between them), and colours covering less than MIN_LAYER_FRACTION of
+# the image get no layer of their own
+COLOR_MERGE_DISTANCE = float(os.getenv("COLOR_MERGE_DISTANCE", "64"))
+MAX_BLEND_FRACTION = float(os.getenv("MAX_BLEND_FRACTION", "0.05"))
+MIN_LAYER_FRACTION = float(os.getenv("MIN_LAYER_FRACTION", "0.01"))
+# Running stitches ("normal", "running" and "jump" stitch types): contours are resampled into
+# stitches of about RUNNING_STITCH_LENGTH (pattern units), kept between the min and max
+# lengths, with turns sharper than CORNER_ANGLE degrees kept as needle points. Requests may
+# choose a stitch length from RUNNING_MIN_LENGTH up to MAX_STITCH_LENGTH.
+RUNNING_STITCH_LENGTH = float(os.getenv("RUNNING_STITCH_LENGTH", "25"))
+RUNNING_MIN_LENGTH = float(os.getenv("RUNNING_MIN_LENGTH", "10"))
+RUNNING_MAX_LENGTH = float(os.getenv("RUNNING_MAX_LENGTH", str(MAX_STITCH_LENGTH)))
+CORNER_ANGLE = float(os.getenv("CORNER_ANGLE", "30"))
+# Tatami fill ("fill" stitch type): needle points every FILL_STITCH_LENGTH along a row (pattern
+# units), each row shifted by 1/FILL_STAGGER of that from the previous one
+FILL_STITCH_LENGTH = float(os.getenv("FILL_STITCH_LENGTH", "40"))
+FILL_STAGGER = int(os.getenv("FILL_STAGGER", "3"))
+# Closest fill rows a request may ask for (pattern units), and the most stitches a fill may
+# have; denser requests are refused rather than left to exhaust the worker's memory
+MIN_FILL_SPACING = float(os.getenv("MIN_FILL_SPACING", "1"))
+MAX_FILL_STITCHES = int(os.getenv("MAX_FILL_STITCHES", "500000"))
+# Satin columns ("satin" stitch type) cover parts of the design up to this wide (pattern units);
+# wider parts keep their outline
+SATIN_MAX_WIDTH = float(os.getenv("SATIN_MAX_WIDTH", str(MAX_STITCH_LENGTH)))
+# Closest satin stitches a request may ask for (pattern units); the outlines are sampled at
+# this spacing and every sample casts a ray, so finer ones cost memory without adding coverage
+MIN_SATIN_SPACING = float(os.getenv("MIN_SATIN_SPACING", "1"))
+# Contours are reordered to shorten the travel between them; the 2-opt refinement of the
+# greedy order may take up to this many seconds per design (0 skips it). Most of its gain comes
+# in the first few tens of milliseconds, and the budget is spent on every settings tweak
+TRAVEL_2OPT_SECONDS = float(os.getenv("TRAVEL_2OPT_SECONDS", "0.03"))
+# Moves between contours up to TRAVEL_STITCH_MAX (pattern units, 0.1 mm) are sewn as a
+# travel stitch; longer ones are jumped, and trimmed first when longer than TRIM_MIN_LENGTH
+TRAVEL_STITCH_MAX = float(os.getenv("TRAVEL_STITCH_MAX", "30"))
+TRIM_MIN_LENGTH = float(os.getenv("TRIM_MIN_LENGTH", "50"))
+# Write DST files with the built-in numpy encoder (same bytes as pyembroidery's write_dst,
+# which stays in use for plans the encoder doesn't handle); 0 always uses pyembroidery
+NATIVE_DST_ENCODER = os.getenv("NATIVE_DST_ENCODER", "1") == "1"
+
+# Result cache. Bump PIPELINE_VERSION whenever a change alters the generated DST files,
+# so results from older pipelines are never served.
+PIPELINE_VERSION = "10"
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "1024"))
+STAGE_CACHE_MAX_MB = float(os.getenv("STAGE_CACHE_MAX_MB", "2048"))  # 0 disables the stage cache
+
+# Intermediate artifacts are passed between stages in memory. They only touch the disk
+# for the /preview/ endpoint, the stage cache, or when persisted for debugging.
+SAVE_PREVIEWS = os.getenv("SAVE_PREVIEWS", "1") == "1"
+DEBUG_PERSIST_ARTIFACTS = os.getenv("DEBUG_PERSIST_ARTIFACTS", "0") == "1"
+# Uploads are parsed as they arrive: bodies over the size limit are refused before they are
+# read, and at most UPLOAD_HEADER_MAX bytes of a file are held while looking for its size
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_FORM_FIELD_BYTES = 4096
+UPLOAD_HEADER_MAX = 256 * 1024
+# Uploads are streamed to disk; ones up to UPLOAD_MEMORY_MAX_MB are also kept in memory until
+# their job starts, so the pipeline doesn't read them back (at most UPLOAD_BUFFER_TOTAL_MB in all)
+UPLOAD_MEMORY_MAX_MB = float(os.getenv("UPLOAD_MEMORY_MAX_MB", "2"))
+UPLOAD_BUFFER_TOTAL_MB = float(os.getenv("UPLOAD_BUFFER_TOTAL_MB", "64"))
+
 
 # ---------------------
 # FastAPI App Initialization
@@ -112,19 +262,797 @@ class ConnectionManager:
         self.active_connections[client_id] = websocket
         logging.info(f"WebSocket connected: {client_id}")
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            logging.info(f"WebSocket disconnected: {client_id}")
-
-    async def send_message(self, client_id: str, message: str):
+    def disconnect(self, client_id: str, websocket: WebSocket) -> bool:
+        """Forget a client's socket, unless it has since been replaced by a newer one."""
+        if self.active_connections.get(client_id) is not websocket:
+            return False
+        del self.active_connections[client_id]
+        logging.info(f"WebSocket disconnected: {client_id}")
+        return True
+
+    async def send_message(self, client_id: str, message: str, job_id: Optional[str] = None):
+        """
+        Send a message to a client. Progress of a job is sent as {"job_id", "message"} JSON, so
+        a client that has moved on to a new upload can tell an older job's messages apart.
+        """
         if client_id in self.active_connections:
             websocket = self.active_connections[client_id]
-            await websocket.send_text(message)
-            logging.info(f"Sent message to {client_id}: {message}")
+            text = message if job_id is None else json.dumps({"job_id": job_id, "message": message})
+            try:
+                await websocket.send_text(text)
+                logging.info(f"Sent message to {client_id}: {message}")
+            except Exception as e:
+                # A dead socket must never fail the job that is reporting progress
+                logging.warning(f"Could not send message to {client_id}: {e}")
+                self.disconnect(client_id, websocket)
 
 manager = ConnectionManager()
 
+# ---------------------
+# Cancellation
+# ---------------------
+
+class JobCancelled(Exception):
+    """Raised inside the pipeline when the job it is working on has been cancelled."""
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag for one job. It is backed by a marker file so worker
+    processes can see it; pipeline stages call check() between chunks of work.
+    """
+    def __init__(self, job_id: str):
+        self.path = CANCEL_DIR / job_id
+
+    @property
+    def cancelled(self) -> bool:
+        return self.path.exists()
+
+    def cancel(self):
+        self.path.touch()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Job was cancelled.")
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def clear_all():
+        """Drop markers left behind by a previous process."""
+        for marker in CANCEL_DIR.iterdir():
+            marker.unlink(missing_ok=True)
+
+# ---------------------
+# Stage Runner
+# ---------------------
+
+class StageRunner:
+    """
+    Runs CPU-bound pipeline stages in worker processes, enforcing a timeout per stage.
+    Every worker is an executor of its own with a single process, so a stage that overruns
+    its timeout, or whose process dies, costs only that worker: it is killed and replaced
+    without touching the stages other jobs are running.
+    """
+    def __init__(self, max_workers: int, max_tasks_per_child: int, timeouts: Dict[str, float]):
+        self.max_workers = max(1, max_workers)
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self.timeouts = timeouts
+        self._workers: set = set()
+        self._idle: Optional[asyncio.Queue] = None
+
+    def _new_worker(self) -> ProcessPoolExecutor:
+        # Recycling workers is not supported with fork, so always spawn them
+        worker = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=self.max_tasks_per_child,
+        )
+        self._workers.add(worker)
+        return worker
+
+    def _kill(self, worker: ProcessPoolExecutor):
+        """Stop a worker now, even in the middle of a stage."""
+        self._workers.discard(worker)
+        # The executor has no public way to kill its process; its stage would run on otherwise
+        for process in list((worker._processes or {}).values()):
+            process.kill()
+        worker.shutdown(wait=False, cancel_futures=True)
+
+    def start(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.max_workers):
+                self._idle.put_nowait(self._new_worker())
+            logging.info(f"Stage runner started with {self.max_workers} workers")
+
+    def shutdown(self):
+        if self._idle is not None:
+            for worker in list(self._workers):
+                self._kill(worker)
+            self._idle = None
+            logging.info("Stage runner stopped")
+
+    async def run(self, stage: str, func, *args, **kwargs) -> Tuple[object, float]:
+        """
+        Run func(*args, **kwargs) on the next free worker and wait for it without blocking the
+        event loop. Returns its result and how long the worker took, in seconds: both that and
+        the timeout only start once a worker has picked the stage up, so waiting for a free
+        worker counts toward neither.
+        """
+        self.start()
+        idle = self._idle
+        worker = await idle.get()
+        loop = asyncio.get_running_loop()
+        timeout = self.timeouts.get(stage)
+        started = time.monotonic()
+        future = loop.run_in_executor(worker, functools.partial(func, *args, **kwargs))
+        try:
+            result = await asyncio.wait_for(future, timeout=timeout)
+            return result, time.monotonic() - started
+        except asyncio.TimeoutError:
+            logging.error(f"Stage '{stage}' timed out after {timeout}s, replacing its worker")
+            raise TimeoutError(f"{stage} stage timed out after {timeout:g} seconds")
+        except BrokenProcessPool:
+            # The worker died (e.g. killed for memory); replace it for the next stage
+            logging.error(f"Worker broke during stage '{stage}', replacing it")
+            raise
+        finally:
+            # A timeout or a cancelled job task cancels only the wait; the process computes on,
+            # so it is killed and replaced, as is one whose process died
+            healthy = (future.done() and not future.cancelled()
+                       and not isinstance(future.exception(), BrokenProcessPool))
+            if idle is self._idle:
+                if not healthy:
+                    self._kill(worker)
+                    worker = self._new_worker()
+                idle.put_nowait(worker)
+
+stage_runner = StageRunner(WORKER_POOL_SIZE, WORKER_MAX_TASKS_PER_CHILD, STAGE_TIMEOUTS)
+
+# ---------------------
+# Job Store
+# ---------------------
+
+class JobStore:
+    """
+    SQLite-backed record of digitization jobs, so queued and running work survives restarts.
+    Job states: queued -> running -> done | failed, and queued | running -> cancelled.
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                client_id TEXT NOT NULL,
+                upload_path TEXT NOT NULL,
+                output_filename TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                state TEXT NOT NULL,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        self._add_missing_columns({
+            "lane": "TEXT NOT NULL DEFAULT 'interactive'",
+            "tenant": "TEXT NOT NULL DEFAULT ''",
+            "pixels": "INTEGER NOT NULL DEFAULT 0",
+            "cache_key": "TEXT",
+            "content_hash": "TEXT",
+            "long_edge": "INTEGER NOT NULL DEFAULT 0",
+        })
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def _add_missing_columns(self, columns: Dict[str, str]):
+        """Upgrade job databases created by older versions in place."""
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in columns.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def _to_dict(self, row) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = {key: row[key] for key in row.keys() if key != "MIN(created_at)"}
+        job["settings"] = json.loads(job["settings"])
+        return job
+
+    def create(self, client_id: str, upload_path: Path, output_filename: str, settings: Dict,
+               lane: str = "interactive", tenant: Optional[str] = None, pixels: int = 0,
+               cache_key: Optional[str] = None, content_hash: Optional[str] = None,
+               long_edge: int = 0, state: str = "queued") -> Dict:
+        """Record a new job. Jobs answered from the result cache are created directly as 'done'."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        finished_at = now if state == "done" else None
+        self._conn.execute(
+            "INSERT INTO jobs (id, client_id, upload_path, output_filename, settings, state, created_at, "
+            "started_at, finished_at, lane, tenant, pixels, cache_key, content_hash, long_edge) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, client_id, str(upload_path), output_filename, json.dumps(settings), state, now,
+             finished_at, finished_at, lane, tenant or f"client:{client_id}", pixels, cache_key, content_hash,
+             long_edge)
+        )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def queued_heads(self) -> List[Dict]:
+        """The oldest queued job of every (lane, tenant) pair - the scheduler's candidates."""
+        # SQLite returns the bare columns of the row holding MIN(created_at)
+        rows = self._conn.execute(
+            "SELECT *, MIN(created_at) FROM jobs WHERE state = 'queued' GROUP BY lane, tenant"
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def active_jobs(self) -> List[Dict]:
+        """All queued and running jobs, for load estimates."""
+        rows = self._conn.execute(
+            "SELECT id, lane, state, pixels, started_at FROM jobs WHERE state IN ('queued', 'running')"
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, job_id: str) -> Optional[Dict]:
+        """Atomically move a queued job to running; None if someone else got it first."""
+        row = self._conn.execute(
+            "UPDATE jobs SET state = 'running', started_at = ?, attempts = attempts + 1 "
+            "WHERE id = ? AND state = 'queued' RETURNING *",
+            (time.time(), job_id)
+        ).fetchone()
+        return self._to_dict(row)
+
+    def finish(self, job_id: str):
+        self._conn.execute(
+            "UPDATE jobs SET state = 'done', error = NULL, finished_at = ? WHERE id = ? AND state = 'running'",
+            (time.time(), job_id)
+        )
+
+    def fail(self, job_id: str, error: str):
+        self._conn.execute(
+            "UPDATE jobs SET state = 'failed', error = ?, finished_at = ? WHERE id = ? AND state = 'running'",
+            (error, time.time(), job_id)
+        )
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """Cancel a queued or running job, returning the state it was in; None if it had already finished."""
+        for state in ("queued", "running"):
+            # One state per statement, so a job claimed in between is still seen as running
+            if self._conn.execute(
+                "UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ? AND state = ?",
+                (time.time(), job_id, state)
+            ).rowcount:
+                return state
+        return None
+
+    def active_job_ids(self, client_id: str, lane: Optional[str] = None) -> List[str]:
+        """Queued and running jobs of one client, optionally limited to one lane."""
+        query = "SELECT id FROM jobs WHERE client_id = ? AND state IN ('queued', 'running')"
+        params = [client_id]
+        if lane is not None:
+            query += " AND lane = ?"
+            params.append(lane)
+        return [row["id"] for row in self._conn.execute(query, params)]
+
+    def recover(self, max_attempts: int) -> int:
+        """
+        Requeue jobs left running by a previous process. Assumes one API process per jobs directory.
+        Jobs that already used up their attempts are failed instead of retried forever.
+        """
+        self._conn.execute(
+            "UPDATE jobs SET state = 'failed', error = 'Gave up after repeated interruptions.', finished_at = ? "
+            "WHERE state = 'running' AND attempts >= ?",
+            (time.time(), max_attempts)
+        )
+        return self._conn.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'").rowcount
+
+job_store = JobStore(JOBS_DB)
+
+# ---------------------
+# Result Cache
+# ---------------------
+
+def normalize_settings(settings: Dict) -> str:
+    """Canonical text form of the digitization settings, for cache keys."""
+    return json.dumps(settings, sort_keys=True, separators=(",", ":"))
+
+def get_cache_key(content_hash: str, settings: Dict) -> str:
+    """Cache key of a result: what was uploaded, how it was digitized and by which pipeline."""
+    key = f"{PIPELINE_VERSION}\0{content_hash}\0{normalize_settings(settings)}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed store of finished DST files with a size bound and LRU eviction.
+    Entries are hard-linked into OUTPUT_DIR, so a hit costs no copying and evicting
+    an entry never removes a file a client may still download. The preview SVG of a
+    result is kept next to its DST, so a hit gets its preview too.
+    """
+    def __init__(self, db_path: Path, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS result_cache_lru ON result_cache (last_used)")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.dst"
+
+    def get(self, key: str, target: Path, preview_target: Optional[Path] = None) -> bool:
+        """On a hit, place the cached DST at target, and its preview at preview_target, and return True."""
+        row = self._conn.execute("SELECT key FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        try:
+            link_file(self._path(key), target)
+        except FileNotFoundError:
+            # Entry lost its file (e.g. cleaned up by hand); treat as a miss
+            self._conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            return False
+        preview = self._path(key).with_suffix(".svg")
+        if preview_target is not None and preview.exists():
+            link_file(preview, preview_target)
+        self._conn.execute("UPDATE result_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def put(self, key: str, source: Path, preview: Optional[Path] = None):
+        """
+        Add a finished DST, and its preview when there is one, to the cache and evict least
+        recently used entries over the bound.
+        """
+        path = self._path(key)
+        if not path.exists():
+            link_file(source, path)
+        size = path.stat().st_size
+        if preview is not None and preview.exists():
+            link_file(preview, path.with_suffix(".svg"))
+            size += path.with_suffix(".svg").stat().st_size
+        self._conn.execute(
+            "INSERT OR REPLACE INTO result_cache (key, size, last_used) VALUES (?, ?, ?)",
+            (key, size, time.time())
+        )
+        self._evict()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for row in self._conn.execute("SELECT key, size FROM result_cache ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._path(row["key"]).unlink(missing_ok=True)
+            self._path(row["key"]).with_suffix(".svg").unlink(missing_ok=True)
+            self._conn.execute("DELETE FROM result_cache WHERE key = ?", (row["key"],))
+            total -= row["size"]
+            logging.info(f"Evicted cached result {row['key']}")
+
+result_cache = ResultCache(JOBS_DB, RESULT_CACHE_DIR, int(RESULT_CACHE_MAX_MB * 1024 * 1024))
+
+# ---------------------
+# Stage Cache
+# ---------------------
+
+class StageCache:
+    """
+    Intermediate artifacts of the pipeline - the thresholded bitmap (or colour layers) and the
+    traced vector paths - keyed by the upload hash plus only the parameters each stage depends on.
+    Changing stitch settings on the same image therefore skips straight to stitch generation.
+    Artifacts are plain files, so worker processes read and write them directly.
+    """
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts) -> str:
+        data = json.dumps([PIPELINE_VERSION, *parts], sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def bitmap_key(self, content_hash: str, long_edge: int) -> str:
+        return self.key("bitmap", content_hash, PREPROCESS_PARAMS, long_edge)
+
+    def layers_key(self, content_hash: str, colors: int, long_edge: int) -> str:
+        return self.key("layers", content_hash, PREPROCESS_PARAMS, long_edge, colors, KMEANS_SAMPLE_PIXELS,
+                        COLOR_MERGE_DISTANCE, MAX_BLEND_FRACTION, MIN_LAYER_FRACTION)
+
+    def vector_key(self, bitmap_key: str, tracer: str) -> str:
+        return self.key("vector", bitmap_key, tracer, TRACING_BACKENDS[tracer].params)
+
+    def path(self, key: str, suffix: str) -> Path:
+        return self.directory / f"{key}{suffix}"
+
+    def lookup(self, path: Path) -> bool:
+        """True if the artifact exists; marks it as recently used."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self):
+        """Delete least recently used artifacts until the cache fits its size bound."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+
+stage_cache = StageCache(STAGE_CACHE_DIR, int(STAGE_CACHE_MAX_MB * 1024 * 1024))
+
+# ---------------------
+# Job Scheduler
+# ---------------------
+
+class FairScheduler:
+    """
+    Chooses the next job to run. Lanes are served in strict priority order; inside a lane,
+    tenants are interleaved with start-time fair queuing so one client submitting hundreds
+    of images cannot starve the others. Tenants at their concurrency cap are skipped.
+    """
+    def __init__(self, lanes: List[str], max_per_tenant: int, lane_limits: Dict[str, int],
+                 weights: Dict[str, float]):
+        self.lanes = lanes
+        self.max_per_tenant = max(1, max_per_tenant)
+        self.lane_limits = lane_limits
+        self.weights = weights
+        self._virtual_time = {lane: 0.0 for lane in lanes}
+        self._finish_tags: Dict[tuple, float] = {}
+        self._running_by_tenant: Dict[str, int] = {}
+        self._running_by_lane: Dict[str, int] = {lane: 0 for lane in lanes}
+
+    def pick(self, candidates: List[Dict]) -> Optional[Dict]:
+        """
+        Pick one job out of the queued heads (one per lane and tenant) and count it as running.
+        """
+        for lane in self.lanes:
+            if self._running_by_lane[lane] >= self.lane_limits.get(lane, float("inf")):
+                continue
+            best, best_start = None, None
+            for job in candidates:
+                if job["lane"] != lane or self._running_by_tenant.get(job["tenant"], 0) >= self.max_per_tenant:
+                    continue
+                start = max(self._virtual_time[lane], self._finish_tags.get((lane, job["tenant"]), 0.0))
+                if best is None or (start, job["created_at"]) < (best_start, best["created_at"]):
+                    best, best_start = job, start
+            if best is not None:
+                weight = self.weights.get(best["tenant"], 1.0)
+                self._finish_tags[(lane, best["tenant"])] = best_start + 1.0 / weight
+                self._virtual_time[lane] = best_start
+                self._running_by_tenant[best["tenant"]] = self._running_by_tenant.get(best["tenant"], 0) + 1
+                self._running_by_lane[lane] += 1
+                return best
+        return None
+
+    def release(self, job: Dict):
+        """Mark a picked job as no longer occupying a worker."""
+        remaining = self._running_by_tenant.get(job["tenant"], 1) - 1
+        if remaining > 0:
+            self._running_by_tenant[job["tenant"]] = remaining
+        else:
+            self._running_by_tenant.pop(job["tenant"], None)
+        self._running_by_lane[job["lane"]] -= 1
+
+scheduler = FairScheduler(LANES, MAX_JOBS_PER_CLIENT, {"bulk": BULK_MAX_CONCURRENCY}, TENANT_WEIGHTS)
+
+# ---------------------
+# Job Dispatcher
+# ---------------------
+
+class JobDispatcher:
+    """
+    Claims queued jobs from the store and runs them, keeping the worker pool busy.
+    """
+    def __init__(self, store: JobStore, scheduler: FairScheduler, concurrency: int):
+        self.store = store
+        self.scheduler = scheduler
+        self.concurrency = max(1, concurrency)
+        self._running: set = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        recovered = self.store.recover(JOB_MAX_ATTEMPTS)
+        if recovered:
+            logging.info(f"Requeued {recovered} unfinished jobs")
+        CancellationToken.clear_all()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+
+    def notify(self):
+        """Wake the dispatcher when a new job has been queued."""
+        self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            while len(self._running) < self.concurrency:
+                job = self.scheduler.pick(self.store.queued_heads())
+                if job is None:
+                    break
+                claimed = self.store.claim(job["id"])
+                if claimed is None:
+                    self.scheduler.release(job)
+                    continue
+                task = asyncio.create_task(digitize_image(claimed))
+                self._running.add(task)
+                task.add_done_callback(functools.partial(self._job_done, claimed))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _job_done(self, job: Dict, task: asyncio.Task):
+        self._running.discard(task)
+        self.scheduler.release(job)
+        self.notify()
+
+dispatcher = JobDispatcher(job_store, scheduler, WORKER_POOL_SIZE)
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Cancel a job. Queued jobs are simply never started; running ones stop at their next checkpoint.
+    """
+    state = job_store.cancel(job_id)
+    if state is None:
+        return False
+    if state == "running":
+        # Only a running job has a pipeline to stop, and clears the marker when it does
+        CancellationToken(job_id).cancel()
+    upload_buffers.pop(job_id)
+    logging.info(f"Cancelled job {job_id}")
+    return True
+
+def cancel_client_jobs(client_id: str, lane: Optional[str] = None) -> int:
+    """Cancel every active job of a client, e.g. when its WebSocket drops."""
+    return sum(cancel_job(job_id) for job_id in job_store.active_job_ids(client_id, lane))
+
+def supersede_client_jobs(client_id: str, lane: str):
+    """A new interactive upload replaces whatever that client was still waiting for."""
+    if lane == "interactive":
+        superseded = cancel_client_jobs(client_id, lane="interactive")
+        if superseded:
+            logging.info(f"Upload from {client_id} superseded {superseded} earlier jobs")
+
+# ---------------------
+# Admission Control
+# ---------------------
+
+class AdmissionController:
+    """
+    Decides whether a new upload can be accepted, based on queue depth and the pixel
+    volume of queued and running jobs, and estimates when accepted work will start and finish.
+    Estimates come from the throughput each pipeline stage has actually achieved recently.
+    An admitted upload holds its share of the limits until it is released, which the upload
+    does once its job is in the store (or it was given up), so concurrent uploads can't all
+    squeeze into room for one.
+    """
+    def __init__(self, store: JobStore, workers: int, max_queue_depth: int, max_inflight_pixels: float,
+                 stages: List[str], throughput_prior: float, smoothing: float = 0.2):
+        self.store = store
+        self.workers = max(1, workers)
+        self.max_queue_depth = max(1, max_queue_depth)
+        self.max_inflight_pixels = max(1.0, max_inflight_pixels)
+        self.smoothing = smoothing
+        # Exponentially weighted throughput per stage, in pixels per second
+        self.throughput = {stage: throughput_prior * 1e6 for stage in stages}
+        # Admitted uploads that are still streaming in, counted as queued jobs until released
+        self._reservations: Dict[str, Dict] = {}
+
+    def record(self, stage: str, pixels: int, seconds: float):
+        """Feed the observed duration of one stage run into the throughput estimate."""
+        if pixels <= 0 or seconds <= 0:
+            return
+        observed = pixels / seconds
+        previous = self.throughput.get(stage, observed)
+        self.throughput[stage] = previous + self.smoothing * (observed - previous)
+
+    def job_seconds(self, pixels: int) -> float:
+        """Estimated run time of one job through all stages."""
+        return sum(pixels / rate for rate in self.throughput.values())
+
+    def load(self) -> Dict:
+        """Current queue depth, in-flight pixels, remaining work and saturation."""
+        now = time.time()
+        active = self.store.active_jobs()
+        queued = [job for job in active if job["state"] == "queued"] + list(self._reservations.values())
+        running = [job for job in active if job["state"] == "running"]
+        inflight_pixels = sum(job["pixels"] for job in queued + running)
+        # Work left on running jobs, in worker-seconds
+        running_seconds = sum(
+            max(0.0, self.job_seconds(job["pixels"]) - (now - (job["started_at"] or now)))
+            for job in running
+        )
+        return {
+            "queued": queued,
+            "queue_depth": len(queued),
+            "running": len(running),
+            "inflight_pixels": inflight_pixels,
+            "running_seconds": running_seconds,
+            "saturation": max(len(queued) / self.max_queue_depth,
+                              inflight_pixels / self.max_inflight_pixels),
+        }
+
+    def admit(self, pixels: int, lane: str) -> Tuple[str, Dict]:
+        """
+        Accept a job of the given size or raise a 429 with an honest Retry-After.
+        Returns a reservation to release() once the job is queued, and the estimated start
+        and completion times (epoch seconds) for accepted work.
+        """
+        load = self.load()
+        over_depth = load["queue_depth"] + 1 - self.max_queue_depth
+        over_pixels = load["inflight_pixels"] + pixels - self.max_inflight_pixels
+        if over_depth > 0 or over_pixels > 0:
+            # Time until enough queued work has drained for this job to fit
+            average_pixels = load["inflight_pixels"] / max(1, load["queue_depth"] + load["running"])
+            excess_pixels = max(over_depth * average_pixels, over_pixels)
+            retry_after = max(1, math.ceil(self.job_seconds(excess_pixels) / self.workers))
+            logging.warning(f"Rejecting upload: queue depth {load['queue_depth']}, "
+                            f"in-flight pixels {load['inflight_pixels']}, retry after {retry_after}s")
+            raise HTTPException(
+                status_code=429,
+                detail="Server is busy, please retry later.",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+        # Work queued in this lane or a higher-priority one goes first
+        ahead = LANES[:LANES.index(lane) + 1]
+        queued_seconds = sum(self.job_seconds(job["pixels"]) for job in load["queued"] if job["lane"] in ahead)
+        start = time.time() + (queued_seconds + load["running_seconds"]) / self.workers
+        reservation = uuid.uuid4().hex
+        self._reservations[reservation] = {"state": "queued", "lane": lane, "pixels": pixels}
+        return reservation, {"estimated_start": start, "estimated_completion": start + self.job_seconds(pixels)}
+
+    def release(self, reservation: Optional[str]):
+        """Give back what an admitted upload held, once its job is in the store or it was dropped."""
+        if reservation is not None:
+            self._reservations.pop(reservation, None)
+
+admission = AdmissionController(
+    job_store, WORKER_POOL_SIZE, MAX_QUEUE_DEPTH, MAX_INFLIGHT_MEGAPIXELS * 1e6,
+    list(STAGE_TIMEOUTS), STAGE_THROUGHPUT_PRIOR
+)
+
+# ---------------------
+# Upload Ingestion
+# ---------------------
+
+class MultipartStream:
+    """
+    Parses a multipart/form-data request body while it is being received, instead of letting
+    Starlette spool every file to a temporary file first. events() yields ("field", name, value)
+    for each form field and, for a file, ("file", name, (filename, content type)) as soon as its
+    headers are in, then ("data", name, chunk) for every piece of it as it arrives.
+    """
+    def __init__(self, request: Request, max_field_size: int = MAX_FORM_FIELD_BYTES):
+        self.request = request
+        self.max_field_size = max_field_size
+        self._events: List[Tuple[str, str, object]] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_name = self._header_value = b""
+        self._name = ""
+        self._field: Optional[bytearray] = None  # None while the part is a file
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = self._header_value = b""
+
+    def _on_headers_finished(self):
+        disposition, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode(errors="replace")
+        if b"filename" in options:
+            self._field = None
+            filename = options[b"filename"].decode(errors="replace")
+            self._events.append(("file", self._name, (filename, self._headers.get(b"content-type", b"").decode())))
+        else:
+            self._field = bytearray()
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._field is None:
+            self._events.append(("data", self._name, data[start:end]))
+        elif len(self._field) + end - start > self.max_field_size:
+            raise HTTPException(status_code=400, detail=f"Form field {self._name} is too long.")
+        else:
+            self._field += data[start:end]
+
+    def _on_part_end(self):
+        if self._field is not None:
+            self._events.append(("field", self._name, self._field.decode(errors="replace")))
+
+    async def events(self):
+        content_type, options = parse_options_header(self.request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body.")
+        parser = MultipartParser(options[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+        async for chunk in self.request.stream():
+            parser.write(chunk)
+            # The callbacks only queue events, so the consumer can await between them
+            for event in self._events:
+                yield event
+            self._events.clear()
+        parser.finalize()
+        for event in self._events:
+            yield event
+
+def read_image_size(head: bytes) -> Optional[Tuple[int, int]]:
+    """Width and height from the start of an image file, or None if they aren't in it (yet)."""
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+class UploadBuffers:
+    """
+    Bytes of small uploads by job id, held until the job starts so the pipeline can decode
+    them without reading the upload file back. Bounded in total; jobs whose bytes didn't fit
+    simply read their file.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._buffers: Dict[str, bytes] = {}
+        self._size = 0
+
+    def put(self, job_id: str, data: bytes):
+        if self._size + len(data) <= self.max_bytes:
+            self._buffers[job_id] = data
+            self._size += len(data)
+
+    def pop(self, job_id: str) -> Optional[bytes]:
+        data = self._buffers.pop(job_id, None)
+        if data is not None:
+            self._size -= len(data)
+        return data
+
+upload_buffers = UploadBuffers(int(UPLOAD_BUFFER_TOTAL_MB * 1024 * 1024))
+
 # ---------------------
 # Pydantic Schemas
 # ---------------------
@@ -133,6 +1061,35 @@ class UploadResponse(BaseModel):
     filename: str
     download_url: str
     message: Optional[str] = "Embroidery file created successfully."
+    job_id: Optional[str] = None
+    estimated_start: Optional[float] = None  # epoch seconds
+    estimated_completion: Optional[float] = None
+
+class JobResponse(BaseModel):
+    job_id: str
+    state: str
+    filename: str
+    download_url: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class UploadForm(BaseModel):
+    """Form fields of an upload; everything but client_id is optional."""
+    client_id: str
+    stitch_density: int = 2
+    stitch_type: str = "normal"
+    priority: str = "interactive"
+    tracer: str = DEFAULT_TRACER
+    simplifier: str = DEFAULT_SIMPLIFIER
+    fill_angle: float = 45.0
+    fill_spacing: float = 4.0
+    satin_spacing: float = 4.0
+    running_length: float = RUNNING_STITCH_LENGTH
+    color_mode: str = "monochrome"
+    colors: int = COLOR_COUNT
+    detail: str = "standard"
 
 class DigitizationSettings(BaseModel):
     stitch_density: Optional[int] = 10  # Example setting
@@ -141,6 +1098,63 @@ class DigitizationSettings(BaseModel):
 # Utility Functions
 # ---------------------
 
+def get_tenant(client_id: str, api_key: Optional[str]) -> str:
+    """Scheduling key for a request: the API key when one is sent, otherwise the client_id."""
+    if api_key:
+        # Never keep raw API keys in the job database
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return f"client:{client_id}"
+
+def parse_upload_form(fields: Dict[str, str]) -> UploadForm:
+    """Validate the form fields of an upload, raising the error the client should see."""
+    try:
+        form = UploadForm(**fields)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    if form.priority not in LANES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority. Use one of: {', '.join(LANES)}.")
+    if form.tracer not in TRACING_BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Invalid tracer. Use one of: {', '.join(TRACING_BACKENDS)}.")
+    if form.simplifier not in SIMPLIFIERS:
+        raise HTTPException(status_code=400, detail=f"Invalid simplifier. Use one of: {', '.join(SIMPLIFIERS)}.")
+    if form.fill_spacing < MIN_FILL_SPACING:
+        raise HTTPException(status_code=400, detail=f"Invalid fill_spacing. Use at least {MIN_FILL_SPACING:g}.")
+    if form.satin_spacing < MIN_SATIN_SPACING:
+        raise HTTPException(status_code=400, detail=f"Invalid satin_spacing. Use at least {MIN_SATIN_SPACING:g}.")
+    if not RUNNING_MIN_LENGTH <= form.running_length <= MAX_STITCH_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Invalid running_length. "
+                                                    f"Use {RUNNING_MIN_LENGTH:g} to {MAX_STITCH_LENGTH:g}.")
+    if form.color_mode not in COLOR_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid color_mode. Use one of: {', '.join(COLOR_MODES)}.")
+    if not 2 <= form.colors <= MAX_COLORS:
+        raise HTTPException(status_code=400, detail=f"Invalid colors. Use 2 to {MAX_COLORS}, "
+                                                    f"the background included.")
+    if form.detail not in DETAIL_LEVELS:
+        raise HTTPException(status_code=400, detail=f"Invalid detail. Use one of: {', '.join(DETAIL_LEVELS)}.")
+    return form
+
+def write_atomic(path: Path, write):
+    """
+    Call write(tmp_path) and move the result into place, so concurrent jobs
+    never see a half-written file.
+    """
+    tmp_path = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp{path.suffix}")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def link_file(source: Path, target: Path):
+    """Hard-link source to target, copying when linking is not possible."""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
 def get_unique_filename(filename: str) -> str:
     """Generate a unique filename to prevent overwriting."""
     unique_id = uuid.uuid4().hex
@@ -151,258 +1165,2074 @@ def get_unique_filename(filename: str) -> str:
 # Digitization Functions
 # ---------------------
 
-async def preprocess_image(image_path: Path) -> Path:
+def encode_pbm(bitmap: np.ndarray) -> bytes:
     """
-    Preprocess the image: convert to grayscale, resize, and apply thresholding.
-    Save the processed image as a BMP file for Potrace.
+    Encode a thresholded image as a binary PBM for Potrace; dark pixels become foreground.
     """
-    try:
-        image = Image.open(image_path).convert('L')  # Convert to grayscale
-        image = image.resize((500, 500))  # Resize as needed
-        image = image.filter(ImageFilter.GaussianBlur(radius=1))  # Noise reduction
-        image_np = np.array(image)
-
-        # Apply adaptive thresholding for better results
-        thresh = cv2.adaptiveThreshold(
-            image_np, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY, 11, 2
+    height, width = bitmap.shape
+    bits = np.packbits(bitmap < 128, axis=1)  # rows are padded to whole bytes, as PBM expects
+    return f"P4\n{width} {height}\n".encode() + bits.tobytes()
+
+# JPEG decoders can scale down by these factors while decoding, for a fraction of the work
+JPEG_REDUCED_FLAGS = {
+    False: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+    True: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+}
+
+def trace_size(detail: str, width: int, height: int) -> Tuple[int, int]:
+    """
+    Long edge an image of the given size is traced at for a detail level, and the pixel count
+    of the traced image. High detail never enlarges an image past its own size: that would
+    only add pixels, not detail.
+    """
+    long_edge = DETAIL_LEVELS[detail]
+    if detail != "standard":
+        long_edge = max(DETAIL_LEVELS["standard"], min(long_edge, max(width, height)))
+    scale = long_edge / max(width, height)
+    return long_edge, max(1, round(width * scale)) * max(1, round(height * scale))
+
+def decode_image(image, long_edge: int, color: bool = False) -> np.ndarray:
+    """
+    Decode an upload (bytes, or a file holding them) once, straight to grayscale (or BGR when
+    color is set), and scale it so its long edge is long_edge pixels, keeping the aspect ratio.
+    JPEGs that are much larger than that are already reduced by the decoder.
+    """
+    if isinstance(image, Path):
+        image = image.read_bytes()
+    flags = cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+    if image[:3] == b"\xff\xd8\xff":
+        # Only the header is parsed here, to pick the largest reduction that stays above long_edge
+        width, height = Image.open(io.BytesIO(image)).size
+        for factor, reduced in sorted(JPEG_REDUCED_FLAGS[color].items(), reverse=True):
+            if max(width, height) >= factor * long_edge:
+                flags = reduced
+                break
+    decoded = cv2.imdecode(np.frombuffer(image, np.uint8), flags)
+    if decoded is None:
+        raise ValueError("Could not decode the image")
+    height, width = decoded.shape[:2]
+    scale = long_edge / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if size == (width, height):
+        return decoded
+    # Area averaging when shrinking, so thin lines fade instead of breaking up; bilinear when enlarging
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(decoded, size, interpolation=interpolation)
+
+def gaussian_radius(sigma: float) -> int:
+    """Radius of the kernel cv2.GaussianBlur picks for an 8-bit image given only sigma."""
+    return (round(sigma * 3 * 2 + 1) | 1) // 2
+
+def threshold_image(image: np.ndarray, token: Optional[CancellationToken] = None) -> bytes:
+    """
+    Blur and adaptively threshold a grayscale image, in place, and return it as PBM bytes.
+
+    When the working memory of the whole image would exceed PREPROCESS_MEMORY_MB, it is
+    processed in square tiles on PREPROCESS_THREADS threads (OpenCV releases the GIL). Each
+    tile is read with a halo as wide as the blur and threshold neighbourhoods together, so
+    the result is exactly that of the whole image at once.
+    """
+    height, width = image.shape
+    halo = gaussian_radius(PREPROCESS_PARAMS["blur_radius"]) + PREPROCESS_PARAMS["block_size"] // 2
+    budget = PREPROCESS_MEMORY_MB * 1024 * 1024
+    # OpenCV's blur and threshold buffers plus the mask take about 5 bytes per pixel processed
+    if 5 * image.size <= budget:
+        side = max(height, width)
+    else:
+        side = max(64, (math.isqrt(int(budget / (5 * PREPROCESS_THREADS))) - 2 * halo) // 8 * 8)
+    tiles = [(top, left) for top in range(0, height, side) for left in range(0, width, side)]
+    bits = np.empty((height, (width + 7) // 8), np.uint8)
+
+    def process(tile: Tuple[int, int]):
+        if token:
+            token.check()
+        top, left = tile
+        bottom, right = min(top + side, height), min(left + side, width)
+        y0, x0 = max(0, top - halo), max(0, left - halo)
+        window = image[y0:min(height, bottom + halo), x0:min(width, right + halo)]
+        if len(tiles) > 1:
+            window = window.copy()  # the neighbouring tiles still need the original pixels
+        cv2.GaussianBlur(window, (0, 0), PREPROCESS_PARAMS["blur_radius"], dst=window)  # Noise reduction
+        cv2.adaptiveThreshold(
+            window, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY, PREPROCESS_PARAMS["block_size"], PREPROCESS_PARAMS["c"], dst=window
         )
+        core = window[top - y0:bottom - y0, left - x0:right - x0]
+        # Tiles start on whole bytes, so their rows pack independently, as PBM expects
+        bits[top:bottom, left // 8:(right + 7) // 8] = np.packbits(core < 128, axis=1)
 
-        processed_filename = image_path.stem + "_processed.bmp"
-        processed_path = PROCESSED_DIR / processed_filename
-        cv2.imwrite(str(processed_path), thresh)
-        logging.info(f"Image preprocessed and saved to {processed_path}")
-        return processed_path
+    if len(tiles) == 1:
+        process(tiles[0])
+    else:
+        with ThreadPoolExecutor(PREPROCESS_THREADS) as pool:
+            list(pool.map(process, tiles))
+        logging.debug(f"Thresholded {width}x{height} in {len(tiles)} tiles of {side}x{side}")
+    return f"P4\n{width} {height}\n".encode() + bits.tobytes()
+
+def preprocess_image(image_path: Path, token: Optional[CancellationToken] = None,
+                     long_edge: int = PREPROCESS_PARAMS["long_edge"], data: Optional[bytes] = None) -> bytes:
+    """
+    Preprocess the image: decode it (from data when the upload's bytes are at hand, otherwise
+    from image_path) to grayscale with a long edge of long_edge pixels, then blur and threshold
+    it. Return the result as PBM bytes for Potrace.
+    """
+    try:
+        image = decode_image(image_path if data is None else data, long_edge)
+        if token:
+            token.check()
+        bitmap = threshold_image(image, token)
+
+        if DEBUG_PERSIST_ARTIFACTS:
+            processed_path = PROCESSED_DIR / (image_path.stem + "_processed.bmp")
+            cv2.imwrite(str(processed_path), (1 - decode_pbm(bitmap)) * 255)
+            logging.info(f"Processed image saved to {processed_path}")
+        logging.info(f"Image preprocessed at {image.shape[1]}x{image.shape[0]}: {image_path}")
+        return bitmap
+    except JobCancelled:
+        raise
     except Exception as e:
         logging.error(f"Error in preprocess_image: {e}")
         raise e
 
-def vectorize_image(processed_image_path: Path) -> Path:
+def palette_distance(color: np.ndarray, palette: List[np.ndarray], blends: bool = False) -> float:
+    """Distance from a colour to the nearest colour of the palette, or blend of two of them."""
+    distance = math.inf
+    for first in palette:
+        for second in (palette if blends else [first]):
+            span = second - first
+            mix = np.clip(np.dot(color - first, span) / max(np.dot(span, span), 1e-9), 0, 1)
+            distance = min(distance, float(np.linalg.norm(first + mix * span - color)))
+    return distance
+
+def quantize_image(image_path: Path, colors: int, token: Optional[CancellationToken] = None,
+                   long_edge: int = PREPROCESS_PARAMS["long_edge"],
+                   data: Optional[bytes] = None) -> List[Tuple[str, bytes]]:
+    """
+    Reduce the image to at most `colors` colours and return one layer per thread colour, as
+    (hex colour, PBM mask) pairs. The palette is learnt by k-means on a sample of the pixels
+    and pruned of near-duplicate and negligible colours, then every pixel is assigned to its
+    nearest colour. The colour that dominates the image border is taken as the background and
+    left out. Layers come largest first, so smaller details are sewn on top. The assignment
+    runs in bands of pixels on PREPROCESS_THREADS threads, sized so their distance matrices
+    stay within PREPROCESS_MEMORY_MB.
+    """
+    try:
+        image = decode_image(image_path if data is None else data, long_edge, color=True)
+        if token:
+            token.check()
+        cv2.GaussianBlur(image, (0, 0), PREPROCESS_PARAMS["blur_radius"], dst=image)
+        pixels = image.reshape(-1, 3)
+        height, width = image.shape[:2]
+
+        # Learn the palette from an even sample; seeded so the same upload gives the same layers
+        sample = pixels[::max(1, len(pixels) // KMEANS_SAMPLE_PIXELS)].astype(np.float32)
+        cv2.setRNGSeed(0)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+        _, sample_labels, centers = cv2.kmeans(sample, min(colors, len(sample)), None, criteria, 3,
+                                               cv2.KMEANS_PP_CENTERS)
+        if token:
+            token.check()
+
+        # k-means always finds as many clusters as asked for. Fold each centre into the more common
+        # ones when it is nearly one of them, or a small blend of two, then drop the colours too
+        # rare to be worth a layer; their pixels go to the nearest remaining colour when assigned
+        counts = np.bincount(sample_labels.ravel(), minlength=len(centers))
+        kept = []
+        for label in np.argsort(-counts, kind="stable"):
+            blend = counts[label] < MAX_BLEND_FRACTION * len(sample)
+            if palette_distance(centers[label], [centers[other] for other in kept], blend) >= COLOR_MERGE_DISTANCE:
+                kept.append(label)
+        centers = centers[kept]
+        nearest = np.argmin(((sample[:, None, :] - centers[None]) ** 2).sum(axis=2), axis=1)
+        shares = np.bincount(nearest, minlength=len(centers)) / len(sample)
+        centers = centers[(shares >= MIN_LAYER_FRACTION) | (shares == shares.max())]
+
+        # Full assignment pass: |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 doesn't change the argmin
+        norms = (centers * centers).sum(axis=1)
+        labels = np.empty(len(pixels), np.uint8)
+        # Per pixel of a band: its float copy and a distance to every centre
+        band = max(1, int(PREPROCESS_MEMORY_MB * 1024 * 1024 / (PREPROCESS_THREADS * 4 * (3 + 2 * len(centers)))))
+
+        def assign(start: int):
+            if token:
+                token.check()
+            chunk = pixels[start:start + band].astype(np.float32)
+            labels[start:start + band] = np.argmin(norms - 2 * chunk @ centers.T, axis=1)
+
+        with ThreadPoolExecutor(PREPROCESS_THREADS) as pool:
+            list(pool.map(assign, range(0, len(pixels), band)))
+        labels = labels.reshape(height, width)
+        border = np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1]))
+        background = np.bincount(border).argmax()
+        counts = np.bincount(labels.ravel(), minlength=len(centers))
+
+        layers = []
+        for label in np.argsort(-counts, kind="stable"):
+            if label == background or counts[label] == 0:
+                continue
+            blue, green, red = np.clip(np.rint(centers[label]), 0, 255).astype(int)
+            color = f"#{red:02x}{green:02x}{blue:02x}"
+            layers.append((color, encode_pbm(np.where(labels == label, 0, 255).astype(np.uint8))))
+        if not layers:
+            # Nothing but background: fail the job rather than hand out an empty design
+            raise ValueError("The image has no colours to sew apart from its background.")
+        logging.info(f"Image quantized into {len(layers)} colour layers: {image_path}")
+        return layers
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logging.error(f"Error in quantize_image: {e}")
+        raise e
+
+def run_potrace(args: List[str], token: Optional[CancellationToken] = None, input: Optional[bytes] = None) -> bytes:
+    """
+    Run potrace and return its standard output, killing it when the job is cancelled
+    or the vectorize timeout expires.
+    """
+    cmd = ['potrace'] + args
+    deadline = time.monotonic() + STAGE_TIMEOUTS["vectorize"]
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        while True:
+            try:
+                stdout, stderr = process.communicate(input, timeout=0.05)
+                break
+            except subprocess.TimeoutExpired:
+                input = None  # already handed to communicate(), which keeps feeding it
+                if token:
+                    token.check()
+                if time.monotonic() > deadline:
+                    raise subprocess.TimeoutExpired(cmd, STAGE_TIMEOUTS["vectorize"])
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return stdout
+
+def decode_pbm(bitmap: bytes) -> np.ndarray:
+    """
+    Decode binary PBM bytes (as made by encode_pbm) into a uint8 mask, 1 where the image is dark.
+    """
+    magic, width, height, pixels = bitmap.split(maxsplit=3)
+    width, height = int(width), int(height)
+    rows = np.frombuffer(pixels, dtype=np.uint8).reshape(height, -1)
+    return np.unpackbits(rows, axis=1, count=width)
+
+# ---------------------
+# Vector Curves
+# ---------------------
+
+class Curves:
+    """
+    A traced design as cubic Béziers in pattern units (0.1 mm, y axis down). controls is an
+    (S, 4, 2) array of control points and contour i is made of the segments
+    offsets[i]:offsets[i + 1]. Every contour is continuous; holes are contours of their own.
+    """
+    __slots__ = ("controls", "offsets")
+
+    def __init__(self, controls: np.ndarray, offsets: np.ndarray):
+        self.controls = controls
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_contours(cls, contours: List[np.ndarray]) -> "Curves":
+        """Join per-contour (S, 4, 2) control arrays, skipping empty ones."""
+        contours = [contour for contour in contours if len(contour)]
+        if not contours:
+            return cls(np.zeros((0, 4, 2)), np.zeros(1, dtype=np.int64))
+        offsets = np.concatenate(([0], np.cumsum([len(contour) for contour in contours])))
+        return cls(np.concatenate(contours), offsets)
+
+SVG_TRANSFORM_RE = re.compile(r"(translate|scale)\(\s*([-+.\d]+)(?:[\s,]+([-+.\d]+))?\s*\)")
+# Command letters of one path in Potrace's subset: subpaths of (relative) lines and curves,
+# relative movetos only at the start or after a closepath
+SVG_SUBSET_RE = re.compile(r"[Mm][MLlCc]*(?:[Zz][Mm][MLlCc]*)*[Zz]?")
+
+def parse_transform(transform: str) -> Tuple[float, float, float, float]:
+    """
+    (scale x, scale y, translate x, translate y) of an SVG transform list made of translate()
+    and scale(), which is all Potrace writes. Raises ValueError for anything else.
+    """
+    if SVG_TRANSFORM_RE.sub("", transform).strip():
+        raise ValueError(f"unsupported transform {transform!r}")
+    sx, sy, tx, ty = 1.0, 1.0, 0.0, 0.0
+    for operation, first, second in SVG_TRANSFORM_RE.findall(transform):
+        first = float(first)
+        if operation == "translate":
+            tx, ty = tx + sx * first, ty + sy * float(second or 0)
+        else:
+            sx, sy = sx * first, sy * float(second or first)
+    return sx, sy, tx, ty
+
+def line_controls(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Straight segments as degree-elevated cubics, shape (S, 4, 2)."""
+    return np.stack((starts, starts + (ends - starts) / 3, ends - (ends - starts) / 3, ends), axis=1)
+
+def chained_positions(values: np.ndarray, resets: np.ndarray) -> np.ndarray:
+    """
+    Absolute positions of a run of points given as relative offsets, restarting from the
+    given value wherever resets is set (which it must be for the first point).
+    """
+    restart = np.maximum.accumulate(np.where(resets, np.arange(len(values)), 0))
+    sums = np.cumsum(np.where(resets[:, None], 0.0, values), axis=0)
+    return values[restart] + sums - sums[restart]
+
+def parse_path_data(paths: List[str]) -> Curves:
     """
-    Vectorize the processed bitmap image using Potrace via command line.
-    Save the output as an SVG file.
+    Curves of SVG path data in the subset Potrace writes: moveto, lineto, curveto and
+    closepath, absolute or relative, with a new subpath after every closepath. The text is
+    scanned as a byte array and all coordinates are resolved together with array operations,
+    with no Python object per token. Raises ValueError for anything else.
     """
+    encoded = [d.encode() for d in paths]
+    data = np.frombuffer(b" ".join(encoded), dtype=np.uint8)
+    folded = data | 0x20
+    alpha = (folded >= ord("a")) & (folded <= ord("z"))
+    separator = np.isin(data, np.frombuffer(b" ,\t\n\r\f", dtype=np.uint8))
+    number = ~(alpha | separator)
+    commands = np.flatnonzero(alpha)
+    number_starts = np.flatnonzero(number & ~np.concatenate(([False], number[:-1])))
+    if not len(commands):
+        return Curves.from_contours([])
+
+    # Each path must open with a command and use only the letters Potrace writes
+    path_offsets = np.cumsum([0] + [len(d) + 1 for d in encoded[:-1]])
+    path_starts = np.searchsorted(commands, path_offsets)
+    path_ends = np.append(path_starts[1:], len(commands))
+    first_command = np.append(commands, len(data))[path_starts]
+    if (np.searchsorted(number_starts, path_offsets) != np.searchsorted(number_starts, first_command)).any():
+        raise ValueError("path data without a command")
+    letter_text = data[commands].tobytes().decode()
+    for first, last in zip(path_starts.tolist(), path_ends.tolist()):
+        if first < last and not SVG_SUBSET_RE.fullmatch(letter_text, first, last):
+            raise ValueError("path data outside potrace's subset")
+
+    # Numbers following each command; a count mismatch means numbers ran together ("1-2")
+    counts = np.diff(np.searchsorted(number_starts, np.append(commands, len(data))))
+    text = np.where(number, data, ord(" ")).astype(np.uint8).tobytes().decode(errors="replace")
+    pairs = np.fromstring(text, sep=" ")
+    if len(pairs) != len(number_starts):
+        raise ValueError("unreadable numbers")
+    letters = data[commands]
+    fresh = np.zeros(len(letters), dtype=bool)
+    fresh[path_starts[path_starts < path_ends]] = True
+
+    closes = (letters | 0x20) == ord("z")
+    if counts[closes].any():
+        raise ValueError("closepath with arguments")
+    new_subpath = (letters | 0x20) == ord("m")
+    closed = np.bincount(np.cumsum(new_subpath)[closes] - 1, minlength=new_subpath.sum()) > 0
+
+    drawing = ~closes
+    counts, letters, fresh = counts[drawing], letters[drawing], fresh[drawing]
+    if (counts % 2).any():
+        raise ValueError("odd number of coordinates")
+    pairs, counts = pairs.reshape(-1, 2), counts // 2
+    lower = letters | 0x20
+    kinds = np.where(lower == ord("m"), 0, np.where(lower == ord("l"), 1, 2))  # m: 0, l: 1, c: 2
+    relative = letters >= ord("a")
+    if (counts == 0).any() or ((kinds == 2) & (counts % 3 != 0)).any():
+        raise ValueError("wrong number of coordinates")
+
+    # Every coordinate pair, with its command, and which of them end a segment or subpath
+    command = np.repeat(np.arange(len(kinds)), counts)
+    within = np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    curve = kinds[command] == 2
+    anchors = np.flatnonzero(~curve | (within % 3 == 2))
+    moves = (kinds[command[anchors]] == 0) & (within[anchors] == 0)
+    absolute = ~relative[command[anchors]]
+    absolute[moves & fresh[command[anchors]]] = True  # a path's first moveto is always absolute
+
+    # Subpath starts chain off each other (a closepath returns to the start), then the
+    # anchors of each subpath chain off its start
+    values = pairs[anchors]
+    values[moves] = chained_positions(values[moves], absolute[moves])
+    positions = chained_positions(values, moves | absolute)
+
+    drawn = np.flatnonzero(~moves)
+    starts, ends = positions[drawn - 1], positions[drawn]
+    controls = line_controls(starts, ends)
+    is_curve = curve[anchors[drawn]]
+    offset = np.where(absolute[drawn][is_curve, None], 0.0, starts[is_curve])
+    controls[is_curve, 1] = pairs[anchors[drawn][is_curve] - 2] + offset
+    controls[is_curve, 2] = pairs[anchors[drawn][is_curve] - 1] + offset
+
+    # Closepaths draw back to the subpath start when they aren't there already
+    subpath = np.cumsum(moves) - 1
+    move_index = np.flatnonzero(moves)
+    last = np.append(move_index[1:], len(anchors)) - 1
+    closing = np.array(closed) & (positions[last] != positions[move_index]).any(axis=1)
+    controls = np.concatenate((controls, line_controls(positions[last[closing]], positions[move_index[closing]])))
+    order = np.argsort(np.concatenate((drawn, last[closing] + 0.5)), kind="stable")
+    controls = controls[order]
+    segments = np.bincount(np.concatenate((subpath[drawn], np.flatnonzero(closing))), minlength=len(move_index))
+    segments = segments[segments > 0]
+    return Curves(controls, np.concatenate(([0], np.cumsum(segments))))
+
+def parse_potrace_svg(svg: str) -> Curves:
+    """
+    Read Potrace's SVG output into Curves without building a DOM or per-segment objects: the
+    path data of the whole document is parsed in one pass and the group transform is applied
+    to the coordinate arrays. Anything outside Potrace's subset falls back to svgpathtools.
+    """
+    try:
+        groups = re.findall(r"<g\b[^>]*>", svg)
+        if len(groups) > 1:
+            raise ValueError("nested groups")
+        transform = re.search(r'transform="([^"]*)"', groups[0]) if groups else None
+        sx, sy, tx, ty = parse_transform(transform.group(1)) if transform else (1.0, 1.0, 0.0, 0.0)
+        data = []
+        for tag in re.findall(r"<path\b[^>]*>", svg):
+            if "transform=" in tag:
+                raise ValueError("transformed path")
+            d = re.search(r'\sd="([^"]*)"', tag)
+            if d:
+                data.append(d.group(1))
+        curves = parse_path_data(data)
+    except ValueError as e:
+        logging.debug(f"Parsing SVG with svgpathtools: {e}")
+        return parse_svg(svg)
+    curves.controls *= (sx * PATTERN_UNITS_PER_PIXEL, sy * PATTERN_UNITS_PER_PIXEL)
+    curves.controls += (tx * PATTERN_UNITS_PER_PIXEL, ty * PATTERN_UNITS_PER_PIXEL)
+    return curves
+
+def cubic_controls(segment) -> List[Tuple]:
+    """
+    Control points of a segment as one or more cubic Béziers: lines and quadratics are
+    degree-elevated, arcs are split into cubic curves.
+    """
+    if isinstance(segment, CubicBezier):
+        return [segment.bpoints()]
+    if isinstance(segment, Line):
+        start, end = segment.bpoints()
+        return [(start, start + (end - start) / 3, end - (end - start) / 3, end)]
+    if isinstance(segment, QuadraticBezier):
+        start, control, end = segment.bpoints()
+        return [(start, start + 2 * (control - start) / 3, end + 2 * (control - end) / 3, end)]
+    curves = max(1, math.ceil(abs(segment.delta) / 90))
+    return [curve.bpoints() for curve in segment.as_cubic_curves(curves=curves)]
+
+def parse_svg(svg: str) -> Curves:
+    """
+    Read any SVG into Curves through svgpathtools. Only the transform of the outermost group
+    is honoured, as svgpathtools itself ignores group transforms.
+    """
+    paths, attributes = svgstr2paths(svg)
+    group = re.search(r"<g\b[^>]*\btransform=\"([^\"]*)\"", svg)
     try:
-        svg_filename = processed_image_path.stem + ".svg"
-        svg_path = PROCESSED_DIR / svg_filename
+        sx, sy, tx, ty = parse_transform(group.group(1)) if group else (1.0, 1.0, 0.0, 0.0)
+    except ValueError as e:
+        logging.warning(f"Ignoring SVG transform: {e}")
+        sx, sy, tx, ty = 1.0, 1.0, 0.0, 0.0
 
-        # Call Potrace to convert BMP to SVG
-        subprocess.run(
-            ['potrace', str(processed_image_path), '-s', '-o', str(svg_path)],
-            check=True
+    contours, controls = [], []
+    for path in paths:
+        previous_end = None
+        for segment in path:
+            if segment.start != previous_end and controls:
+                contours.append(np.array(controls, dtype=complex))
+                controls = []
+            controls.extend(cubic_controls(segment))
+            previous_end = segment.end
+    if controls:
+        contours.append(np.array(controls, dtype=complex))
+    curves = Curves.from_contours([np.stack((contour.real, contour.imag), axis=-1) for contour in contours])
+    curves.controls *= (sx * PATTERN_UNITS_PER_PIXEL, sy * PATTERN_UNITS_PER_PIXEL)
+    curves.controls += (tx * PATTERN_UNITS_PER_PIXEL, ty * PATTERN_UNITS_PER_PIXEL)
+    return curves
+
+def curves_to_svg(curves: Curves, width: int, height: int) -> str:
+    """
+    SVG document of the curves, scaled back to pixels, for previews.
+    """
+    return layers_to_svg([("#000000", curves)], width, height)
+
+def layers_to_svg(layers: List[Tuple[str, Curves]], width: int, height: int) -> str:
+    """
+    SVG document of (fill colour, curves) layers drawn in order, scaled back to pixels, for previews.
+    """
+    groups = []
+    for color, curves in layers:
+        contours = []
+        for first, last in zip(curves.offsets[:-1], curves.offsets[1:]):
+            controls = curves.controls[first:last]
+            start = " ".join(f"{value:.1f}" for value in controls[0, 0])
+            curve = " ".join(f"{value:.1f}" for value in controls[:, 1:].ravel())
+            contours.append(f"M{start}C{curve}z")
+        groups.append(
+            f'<g transform="scale({1 / PATTERN_UNITS_PER_PIXEL})" fill="{color}" fill-rule="evenodd" stroke="none">\n'
+            f'<path d="{"".join(contours)}"/>\n</g>\n'
         )
-        logging.info(f"Vector image saved to {svg_path}")
-        return svg_path
+    return (
+        '<?xml version="1.0" standalone="no"?>\n'
+        f'<svg version="1.0" xmlns="http://www.w3.org/2000/svg" width="{width}pt" height="{height}pt" '
+        f'viewBox="0 0 {width} {height}" preserveAspectRatio="xMidYMid meet">\n'
+        f'{"".join(groups)}</svg>\n'
+    )
+
+# ---------------------
+# Stitch Plan
+# ---------------------
+
+class StitchPlan:
+    """
+    The stitches of a design in flat arrays: coords is an (N, 2) int32 array in pattern units
+    (0.1 mm), commands the pyembroidery command of each point (STITCH, JUMP, TRIM...), and
+    contour i is made of the points offsets[i]:offsets[i + 1].
+    """
+    __slots__ = ("coords", "commands", "offsets")
+
+    def __init__(self, coords: np.ndarray, commands: np.ndarray, offsets: np.ndarray):
+        self.coords = coords
+        self.commands = commands
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    @classmethod
+    def from_contours(cls, contours: List[np.ndarray], command: int = STITCH) -> "StitchPlan":
+        """Round per-contour (N, 2) point arrays to pattern units and join them, skipping empty ones."""
+        contours = [contour for contour in contours if len(contour)]
+        if not contours:
+            return cls(np.zeros((0, 2), dtype=np.int32), np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+        coords = np.rint(np.concatenate(contours)).astype(np.int32)
+        offsets = np.concatenate(([0], np.cumsum([len(contour) for contour in contours])))
+        return cls(coords, np.full(len(coords), command, dtype=np.uint8), offsets)
+
+    def contours(self):
+        """Point arrays of the contours, as views."""
+        for first, last in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield self.coords[first:last]
+
+    def to_pattern(self) -> EmbPattern:
+        """The plan as a pyembroidery pattern, ended with END."""
+        pattern = EmbPattern()
+        pattern.stitches = np.column_stack((self.coords, self.commands)).tolist()
+        if len(self.coords):
+            pattern._previousX, pattern._previousY = self.coords[-1].tolist()
+        pattern.add_command(END)
+        return pattern
+
+# ---------------------
+# Travel Optimization
+# ---------------------
+
+class PointGrid:
+    """
+    Uniform grid over a fixed set of points for nearest-neighbour queries. Points can be
+    switched off (alive) once they are no longer wanted.
+    """
+    def __init__(self, points: np.ndarray, cell_size: float):
+        self.points = points
+        self.cell_size = cell_size
+        self.origin = points.min(axis=0)
+        cells = ((points - self.origin) // cell_size).astype(np.int64)
+        self.width, self.height = (cells.max(axis=0) + 1).tolist()
+        ids = cells[:, 1] * self.width + cells[:, 0]
+        self.order = np.argsort(ids, kind="stable")
+        self.starts = np.searchsorted(ids[self.order], np.arange(self.width * self.height + 1))
+        self.alive = np.ones(len(points), dtype=bool)
+
+    def ring(self, cell: np.ndarray, radius: int) -> np.ndarray:
+        """Ids of the grid cells exactly radius cells away from cell."""
+        x0, y0 = (cell - radius).tolist()
+        x1, y1 = (cell + radius).tolist()
+        xs = np.arange(max(x0, 0), min(x1, self.width - 1) + 1)
+        ys = np.arange(max(y0 + 1, 0), min(y1 - 1, self.height - 1) + 1)
+        parts = []
+        if 0 <= y0 < self.height:
+            parts.append(y0 * self.width + xs)
+        if radius and 0 <= y1 < self.height:
+            parts.append(y1 * self.width + xs)
+        if 0 <= x0 < self.width:
+            parts.append(ys * self.width + x0)
+        if radius and 0 <= x1 < self.width:
+            parts.append(ys * self.width + x1)
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def nearest(self, position: np.ndarray) -> int:
+        """Index of the alive point closest to position, or -1 when none is left."""
+        if not self.alive.any():
+            return -1
+        cell = np.floor((position - self.origin) / self.cell_size).astype(np.int64)
+        cell = np.clip(cell, 0, [self.width - 1, self.height - 1])
+        best, best_distance = -1, np.inf
+        for radius in range(max(self.width, self.height)):
+            cells = self.ring(cell, radius)
+            first = self.starts[cells]
+            counts = self.starts[cells + 1] - first
+            if counts.sum():
+                slots = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                candidates = self.order[slots]
+                candidates = candidates[self.alive[candidates]]
+                if len(candidates):
+                    distances = np.hypot(*(self.points[candidates] - position).T)
+                    closest = distances.argmin()
+                    if distances[closest] < best_distance:
+                        best, best_distance = int(candidates[closest]), distances[closest]
+            # Anything further out is at least radius cells away
+            if best_distance <= radius * self.cell_size:
+                break
+        return best
+
+def travel_length(entries: np.ndarray, exits: np.ndarray) -> float:
+    """Length of the moves from the origin into the first contour and between the others."""
+    starts = np.concatenate(([[0, 0]], exits[:-1]))
+    return float(np.hypot(*(entries - starts).T).sum())
+
+def two_opt(entries: np.ndarray, exits: np.ndarray, deadline: float) -> np.ndarray:
+    """
+    Improve a contour order by reversing runs of it while that shortens the travel, until
+    no reversal helps or the deadline (time.monotonic) passes. entries and exits are updated
+    in place; returns the permutation applied.
+    """
+    count = len(entries)
+    order = np.arange(count)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(count):
+            if time.monotonic() >= deadline:
+                break
+            # Reversing i..j swaps the moves into i and out of j for two new ones
+            previous = exits[i - 1] if i else np.zeros(2)
+            j = np.arange(i, count)
+            following = np.concatenate((entries[i + 1:], [[np.nan, np.nan]]))
+            before = np.hypot(*(entries[i] - previous)) + np.nan_to_num(np.hypot(*(following - exits[j]).T))
+            after = np.hypot(*(exits[j] - previous).T) + np.nan_to_num(np.hypot(*(following - entries[i]).T))
+            best = int(np.argmin(after - before))
+            if after[best] - before[best] < -1e-6:
+                j = i + best
+                entries[i:j + 1], exits[i:j + 1] = exits[i:j + 1][::-1].copy(), entries[i:j + 1][::-1].copy()
+                order[i:j + 1] = order[i:j + 1][::-1].copy()
+                improved = True
+    return order
+
+def order_contours(plan: StitchPlan, time_limit: float = 0.0) -> Tuple[StitchPlan, float, float]:
+    """
+    Reorder the contours of a plan to cut the travel between them: greedy nearest neighbour
+    from the origin over a grid of possible entry points (every point of a closed contour,
+    either end of an open one), then 2-opt for up to time_limit seconds, then a last pass
+    moving each closed contour's entry point to the best spot between its neighbours.
+
+    Returns the reordered plan and the travel before and after, in pattern units.
+    """
+    contours = list(plan.contours())
+    firsts = plan.offsets[:-1]
+    lengths = np.diff(plan.offsets)
+    closed = np.array([len(points) > 2 and (points[0] == points[-1]).all() for points in contours], dtype=bool)
+    before = travel_length(plan.coords[firsts], plan.coords[firsts + lengths - 1])
+    if len(contours) < 2:
+        return plan, before, before
+
+    # Candidate entry points, by index into their contour
+    vertices = [np.arange(len(points) - 1) if is_closed else np.array([0, len(points) - 1])
+                for points, is_closed in zip(contours, closed)]
+    owners = np.repeat(np.arange(len(contours)), [len(v) for v in vertices])
+    vertices = np.concatenate(vertices)
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(owners, minlength=len(contours)))))
+    points = plan.coords[firsts[owners] + vertices].astype(np.float64)
+    extent = np.ptp(points, axis=0)
+    grid = PointGrid(points, max(2 * np.sqrt(max(extent[0] * extent[1], 1.0) / len(points)), 1.0))
+
+    # Greedy: always move to the closest entry point of a contour not sewn yet
+    sequence, entry_vertex = [], []
+    position = np.zeros(2)
+    for _ in range(len(contours)):
+        candidate = grid.nearest(position)
+        contour = owners[candidate]
+        grid.alive[bounds[contour]:bounds[contour + 1]] = False
+        sequence.append(contour)
+        entry_vertex.append(vertices[candidate])
+        exit_vertex = vertices[candidate] if closed[contour] else lengths[contour] - 1 - vertices[candidate]
+        position = contours[contour][exit_vertex].astype(np.float64)
+    sequence = np.array(sequence)
+    entry_vertex = np.array(entry_vertex)
+    exit_vertex = np.where(closed[sequence], entry_vertex, lengths[sequence] - 1 - entry_vertex)
+    entries = plan.coords[firsts[sequence] + entry_vertex].astype(np.float64)
+    exits = plan.coords[firsts[sequence] + exit_vertex].astype(np.float64)
+
+    if time_limit > 0:
+        order = two_opt(entries, exits, time.monotonic() + time_limit)
+        sequence = sequence[order]
+        # Open contours inside a reversed run are now sewn the other way
+        forward = (entries == plan.coords[firsts[sequence]]).all(axis=1)
+        entry_vertex = np.where(closed[sequence], entry_vertex[order], np.where(forward, 0, lengths[sequence] - 1))
+
+    # Enter each closed contour where it costs least given its neighbours
+    for position in range(len(sequence)):
+        contour = sequence[position]
+        if not closed[contour]:
+            continue
+        ring = contours[contour][:-1].astype(np.float64)
+        previous = exits[position - 1] if position else np.zeros(2)
+        cost = np.hypot(*(ring - previous).T)
+        if position + 1 < len(sequence):
+            cost += np.hypot(*(ring - entries[position + 1]).T)
+        entry_vertex[position] = int(cost.argmin())
+        entries[position] = exits[position] = ring[entry_vertex[position]]
+    after = travel_length(entries, exits)
+
+    # Point indices of the new plan: closed contours rotated to their entry, open ones maybe reversed
+    indices = []
+    for contour, vertex in zip(sequence.tolist(), entry_vertex.tolist()):
+        first, length = int(firsts[contour]), int(lengths[contour])
+        if closed[contour]:
+            local = np.concatenate((np.arange(vertex, length - 1), np.arange(vertex + 1)))
+        elif vertex:
+            local = np.arange(length - 1, -1, -1)
+        else:
+            local = np.arange(length)
+        indices.append(first + local)
+    offsets = np.concatenate(([0], np.cumsum(lengths[sequence])))
+    index = np.concatenate(indices)
+    return StitchPlan(plan.coords[index], plan.commands[index], offsets), before, after
+
+def connect_contours(plan: StitchPlan, travel_max: float, trim_min: float) -> Tuple[StitchPlan, Dict[str, int]]:
+    """
+    Decide how the needle gets from each contour to the next (the first one from the origin).
+    Moves up to travel_max stay a travel stitch; longer ones become a JUMP to the contour's
+    first point, which is then stitched, and moves over trim_min also get a TRIM before the
+    jump. The DST writer splits long jumps into a sequence of shorter ones.
+
+    The connectors are inserted at the start of the contour they lead to. Returns the new
+    plan and the number of moves of each kind.
+    """
+    firsts = plan.offsets[:-1]
+    if not len(firsts):
+        return plan, {"travel": 0, "jump": 0, "trim": 0}
+    entries = plan.coords[firsts].astype(np.float64)
+    exits = np.concatenate(([[0, 0]], plan.coords[plan.offsets[1:-1] - 1])).astype(np.float64)
+    lengths = np.hypot(*(entries - exits).T)
+    jumps = lengths > travel_max
+    trims = jumps & (lengths > trim_min)
+    trims[0] = False  # nothing is sewn yet, so there is no thread to cut
+
+    inserted = jumps.astype(np.int64) + trims
+    contour = np.repeat(np.arange(len(firsts)), inserted)
+    is_trim = trims[contour] & (np.arange(len(contour)) == np.repeat(np.cumsum(inserted) - inserted, inserted))
+    coords = np.where(is_trim[:, None], exits[contour], entries[contour]).astype(plan.coords.dtype)
+    commands = np.where(is_trim, TRIM, JUMP).astype(plan.commands.dtype)
+    positions = firsts[contour]
+    offsets = plan.offsets + np.concatenate(([0], np.cumsum(inserted)))
+    connected = StitchPlan(np.insert(plan.coords, positions, coords, axis=0),
+                           np.insert(plan.commands, positions, commands), offsets)
+    counts = {"travel": int((~jumps).sum()), "jump": int((jumps & ~trims).sum()), "trim": int(trims.sum())}
+    return connected, counts
+
+def merge_layers(plans: List[StitchPlan]) -> StitchPlan:
+    """
+    Join the stitch plans of the colour layers into one design, in order. Between two layers
+    the thread is trimmed, the machine stops for a COLOR_CHANGE, and the next layer starts
+    with a jump to its first stitch. The connectors belong to the next layer's first contour.
+    """
+    plans = [plan for plan in plans if len(plan)]
+    if not plans:
+        return StitchPlan.from_contours([])
+    coords, commands, offsets = [plans[0].coords], [plans[0].commands], [plans[0].offsets]
+    total = len(plans[0])
+    for plan in plans[1:]:
+        last = coords[-1][-1]
+        connector = [TRIM, COLOR_CHANGE] if plan.commands[0] == JUMP else [TRIM, COLOR_CHANGE, JUMP]
+        coords.append(np.array([last, last, plan.coords[0]][:len(connector)], dtype=plan.coords.dtype))
+        commands.append(np.array(connector, dtype=plan.commands.dtype))
+        offsets.append(plan.offsets[1:] + total + len(connector))
+        coords.append(plan.coords)
+        commands.append(plan.commands)
+        total += len(connector) + len(plan)
+    return StitchPlan(np.concatenate(coords), np.concatenate(commands), np.concatenate(offsets))
+
+# ---------------------
+# DST Encoder
+# ---------------------
+
+# Longest move a DST record holds along each axis, in pattern units
+DST_MAX_MOVE = 121
+DST_HEADER_SIZE = 512
+# Commands encode_dst handles; plans with anything else are written by pyembroidery
+DST_COMMANDS = (STITCH, JUMP, TRIM, COLOR_CHANGE, STOP)
+
+def dst_move_table(bits) -> np.ndarray:
+    """
+    Record bytes (b0, b1, b2) for every move -121..121 along one axis. A move is stored as five
+    balanced ternary digits; bits gives, from the 81s digit down, the byte and the bits set for +1 and -1.
+    """
+    digits = np.arange(2 * DST_MAX_MOVE + 1)  # move + 121, and 121 is 11111 in base 3
+    table = np.zeros((len(digits), 3), dtype=np.uint8)
+    for weight, (byte, plus, minus) in zip((81, 27, 9, 3, 1), bits):
+        digit = digits // weight % 3
+        table[digit == 2, byte] |= 1 << plus
+        table[digit == 0, byte] |= 1 << minus
+    return table
+
+# Indexed by move + 121. DST's y axis points up, so the y table is built for -dy.
+DST_X_TABLE = dst_move_table([(2, 2, 3), (1, 2, 3), (0, 2, 3), (1, 0, 1), (0, 0, 1)])
+DST_Y_TABLE = dst_move_table([(2, 5, 4), (1, 5, 4), (0, 5, 4), (1, 7, 6), (0, 7, 6)])[::-1]
+DST_JUMP_BITS = 0x83
+DST_TRIM_RECORDS = np.array([DST_X_TABLE[DST_MAX_MOVE + d] | DST_Y_TABLE[DST_MAX_MOVE + d] for d in (2, -4, 2)])
+DST_TRIM_RECORDS[:, 2] |= DST_JUMP_BITS
+
+def normalize_for_dst(plan: StitchPlan) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The records pyembroidery's normalizer would produce for the plan: moves longer than
+    DST_MAX_MOVE get evenly spaced jumps in front of them, trims and colour changes that
+    would do nothing are dropped, and END closes the pattern. Returns the (M, 2) points,
+    where the DST writer places each of them after rounding, and the commands.
+    """
+    commands = plan.commands.astype(np.int64)
+    coords = plan.coords.astype(np.float64)
+    count = len(commands)
+    index = np.arange(count)
+    moves = (commands == STITCH) | (commands == JUMP)
+
+    # Needle position before each command: the last stitch or jump so far, or the origin
+    last_move = np.maximum.accumulate(np.where(moves, index, -1))
+    needle = np.zeros((count + 1, 2))
+    needle[1:] = np.where(last_move[:, None] >= 0, coords[np.maximum(last_move, 0)], 0)
+    before = needle[:-1]
+
+    # A trim only counts while the needle is down, i.e. the last stitch came after any
+    # trim, colour change or stop. Colour changes before anything was sewn are dropped.
+    last_state = np.maximum.accumulate(np.where(commands != JUMP, index, -1))
+    state_before = np.concatenate(([-1], last_state))[:-1]
+    sewing = (state_before >= 0) & (commands[np.maximum(state_before, 0)] == STITCH)
+    started = np.concatenate(([0], np.cumsum((commands == STITCH) | (commands == COLOR_CHANGE))))[:-1] > 0
+    kept = moves | (commands == STOP) | ((commands == TRIM) & sewing) | ((commands == COLOR_CHANGE) & started)
+
+    # Long moves: as many jumps as needed, each stepped on from the previous one
+    delta = np.where(moves[:, None], coords - before, 0)
+    steps = np.ceil(np.abs(delta) / DST_MAX_MOVE).max(axis=1, initial=0)
+    gaps = np.where(np.abs(delta).max(axis=1, initial=0) > DST_MAX_MOVE, steps - 1, 0).astype(np.int64)
+    sizes = np.where(kept, gaps + 1, 0)
+    ends = np.cumsum(sizes)
+    total = int(sizes.sum())
+
+    points = np.empty((total + 1, 2))
+    out_commands = np.full(total + 1, JUMP, dtype=np.int64)
+    points[ends[kept] - 1] = np.where(moves[:, None], coords, before)[kept]
+    out_commands[ends[kept] - 1] = commands[kept]
+    points[total] = needle[-1]
+    out_commands[total] = END
+    placed = points.copy()
+
+    # Jump points are fractional. The writer rounds each move against where the previous
+    # one landed, so (with round-half-even) they are placed one step at a time as well.
+    long_moves = np.flatnonzero(gaps)
+    if len(long_moves):
+        step = delta[long_moves] / steps[long_moves, None]
+        point = before[long_moves].copy()
+        landed = point.copy()
+        first = ends[long_moves] - sizes[long_moves]
+        for k in range(int(gaps.max())):
+            active = gaps[long_moves] > k
+            point[active] += step[active]
+            landed[active] += np.rint(point[active] - landed[active])
+            points[first[active] + k] = point[active]
+            placed[first[active] + k] = landed[active]
+    return points, placed, out_commands
+
+def encode_dst(plan: StitchPlan, name: str = "Untitled") -> Optional[bytes]:
+    """
+    The plan as a DST file, byte-identical to pyembroidery's write_dst. Returns None for
+    plans it can't encode (unsupported commands), which then go through pyembroidery.
+    """
+    if not np.isin(plan.commands, DST_COMMANDS).all():
+        return None
+    points, placed, commands = normalize_for_dst(plan)
+    moves = np.diff(placed, axis=0, prepend=[[0, 0]]).astype(np.int64)
+    if (np.abs(moves) > DST_MAX_MOVE).any():
+        return None
+
+    records = DST_X_TABLE[moves[:, 0] + DST_MAX_MOVE] | DST_Y_TABLE[moves[:, 1] + DST_MAX_MOVE]
+    records[commands == STITCH, 2] |= 0x03
+    records[commands == JUMP, 2] |= DST_JUMP_BITS
+    records[(commands == COLOR_CHANGE) | (commands == STOP)] = (0, 0, 0xC3)
+    records[commands == END] = (0, 0, 0xF3)
+    trims = commands == TRIM
+    if trims.any():
+        records = np.repeat(records, np.where(trims, 3, 1), axis=0)
+        starts = np.flatnonzero(trims) + 2 * np.arange(trims.sum())
+        records[(starts[:, None] + np.arange(3)).ravel()] = np.tile(DST_TRIM_RECORDS, (len(starts), 1))
+
+    (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+    ax, ay = int(points[-1, 0]), -int(points[-1, 1])
+    header = "".join((
+        "LA:%-16s\r" % name,
+        "ST:%7d\r" % len(commands),
+        "CO:%3d\r" % np.count_nonzero(commands == COLOR_CHANGE),
+        "+X:%5d\r" % abs(max_x),
+        "-X:%5d\r" % abs(min_x),
+        "+Y:%5d\r" % abs(max_y),
+        "-Y:%5d\r" % abs(min_y),
+        "AX:%s%5d\r" % ("+" if ax >= 0 else "-", abs(ax)),
+        "AY:%s%5d\r" % ("+" if ay >= 0 else "-", abs(ay)),
+        "MX:+%5d\r" % 0,
+        "MY:+%5d\r" % 0,
+        "PD:%6s\r" % "******",
+    )).encode("utf8") + b"\x1a"
+    return header.ljust(DST_HEADER_SIZE, b" ") + records.tobytes()
+
+# ---------------------
+# Tracing Backends
+# ---------------------
+
+class TracingBackend:
+    """
+    Turns a thresholded bitmap (PBM bytes) into Curves: the outlines of the dark regions,
+    holes included, in pattern units with the y axis pointing down.
+    """
+    name = ""
+    params: Dict = {}
+
+    def trace(self, bitmap: bytes, token: Optional[CancellationToken] = None) -> Tuple[Curves, Optional[str]]:
+        """Return the curves and, if the backend produced one anyway, the SVG document."""
+        raise NotImplementedError
+
+    def trace_many(self, bitmaps: List[bytes],
+                   token: Optional[CancellationToken] = None) -> List[Tuple[Curves, Optional[str]]]:
+        """Trace several bitmaps, returning one (curves, svg) result per bitmap, in order."""
+        return [self.trace(bitmap, token) for bitmap in bitmaps]
+
+class PotraceBackend(TracingBackend):
+    """
+    The potrace command line tool, fed over pipes.
+    """
+    name = "potrace"
+    params = {"args": ["-s"]}
+
+    def trace(self, bitmap: bytes, token: Optional[CancellationToken] = None) -> Tuple[Curves, Optional[str]]:
+        svg = run_potrace(['-', *self.params["args"], '-o', '-'], token, input=bitmap).decode()
+        return parse_potrace_svg(svg), svg
+
+    def trace_many(self, bitmaps: List[bytes],
+                   token: Optional[CancellationToken] = None) -> List[Tuple[Curves, Optional[str]]]:
+        """
+        Trace up to POTRACE_BATCH_SIZE bitmaps per potrace process, so process startup is paid
+        once per batch. Potrace names each output after its input file.
+        """
+        if len(bitmaps) == 1:
+            return [self.trace(bitmaps[0], token)]
+        results = []
+        for offset in range(0, len(bitmaps), POTRACE_BATCH_SIZE):
+            batch = bitmaps[offset:offset + POTRACE_BATCH_SIZE]
+            with tempfile.TemporaryDirectory(dir=TRACE_TMP_DIR) as tmp:
+                inputs = []
+                for index, bitmap in enumerate(batch):
+                    input_path = Path(tmp) / f"{index}.pbm"
+                    input_path.write_bytes(bitmap)
+                    inputs.append(str(input_path))
+                run_potrace([*self.params["args"], *inputs], token)
+                for index in range(len(batch)):
+                    svg = (Path(tmp) / f"{index}.svg").read_text()
+                    results.append((parse_potrace_svg(svg), svg))
+        return results
+
+class OpenCVBackend(TracingBackend):
+    """
+    In-process tracer: OpenCV contours reduced to polygons, then smoothed into cubic Béziers
+    (Catmull-Rom tangents) everywhere except at sharp corners. Avoids spawning a process
+    per job, which dominates the latency on small images.
+    """
+    name = "opencv"
+
+    def __init__(self, epsilon: float = 1.0, corner_angle: float = 60.0, min_area: float = 4.0):
+        # epsilon: polygon tolerance in pixels; corner_angle: turns sharper than this stay corners;
+        # min_area: specks smaller than this many pixels are dropped, like potrace's turdsize
+        self.params = {"epsilon": epsilon, "corner_angle": corner_angle, "min_area": min_area}
+
+    def trace(self, bitmap: bytes, token: Optional[CancellationToken] = None) -> Tuple[Curves, Optional[str]]:
+        mask = decode_pbm(bitmap)
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_NONE)
+        fitted = []
+        for contour in contours:
+            if token:
+                token.check()
+            if cv2.contourArea(contour) >= self.params["min_area"]:
+                fitted.append(self._fit_curves(contour))
+        return Curves.from_contours(fitted), None
+
+    def _fit_curves(self, contour: np.ndarray) -> np.ndarray:
+        polygon = cv2.approxPolyDP(contour, self.params["epsilon"], True)[:, 0, :].astype(float)
+        if len(polygon) < 3:
+            return np.zeros((0, 4, 2))
+        # Pixel centres to pattern units
+        points = ((polygon[:, 0] + 0.5) + 1j * (polygon[:, 1] + 0.5)) * PATTERN_UNITS_PER_PIXEL
+        previous = np.roll(points, 1)
+        following = np.roll(points, -1)
+
+        # Catmull-Rom tangents, dropped at sharp corners so those stay crisp
+        turn = np.abs(np.angle((following - points) / (points - previous)))
+        tangents = (following - previous) / 6
+        tangents[turn > math.radians(self.params["corner_angle"])] = 0
+        controls1 = points + tangents
+        controls2 = following - np.roll(tangents, -1)
+        # Between two corners the segment is straight; give it evenly spaced controls
+        straight = (controls1 == points) & (controls2 == following)
+        controls1[straight] = points[straight] + (following[straight] - points[straight]) / 3
+        controls2[straight] = following[straight] - (following[straight] - points[straight]) / 3
+
+        controls = np.stack((points, controls1, controls2, following), axis=1)
+        return np.stack((controls.real, controls.imag), axis=-1)
+
+TRACING_BACKENDS: Dict[str, TracingBackend] = {
+    backend.name: backend for backend in [PotraceBackend(), OpenCVBackend()]
+}
+
+def vectorize_image(bitmap, token: Optional[CancellationToken] = None,
+                    svg_path: Optional[Path] = None, paths_path: Optional[Path] = None,
+                    tracer: str = DEFAULT_TRACER) -> Curves:
+    """
+    Vectorize the processed bitmap (PBM bytes, or a file holding them) with the chosen
+    tracing backend and return the curves. The SVG is only written to svg_path when given
+    (preview), and the curves are stored at paths_path for the stage cache when given.
+    """
+    try:
+        if isinstance(bitmap, Path):
+            bitmap = bitmap.read_bytes()
+
+        curves, svg = TRACING_BACKENDS[tracer].trace(bitmap, token)
+        logging.info(f"Image vectorized into {len(curves)} contours with {tracer}")
+
+        if svg_path is not None:
+            if svg is None:
+                magic, width, height = bitmap.split(maxsplit=3)[:3]
+                svg = curves_to_svg(curves, int(width), int(height))
+            svg_path.write_text(svg)
+        if paths_path is not None:
+            write_atomic(paths_path, lambda tmp: tmp.write_bytes(pickle.dumps(curves, pickle.HIGHEST_PROTOCOL)))
+            if svg_path is not None:
+                # Keep the SVG with the curves so the preview still works when tracing is skipped
+                link_file(svg_path, paths_path.with_suffix(".svg"))
+        return curves
+    except JobCancelled:
+        logging.info("Vectorizing cancelled")
+        raise
     except subprocess.CalledProcessError as e:
-        logging.error(f"Potrace failed: {e}")
+        logging.error(f"Potrace failed: {e} {e.stderr.decode(errors='replace') if e.stderr else ''}")
         raise e
     except Exception as e:
         logging.error(f"Error in vectorize_image: {e}")
         raise e
 
-def perpendicular_distance(point, start, end):
+def vectorize_images(bitmaps: List, token: Optional[CancellationToken] = None,
+                     paths_paths: Optional[List[Optional[Path]]] = None,
+                     tracer: str = DEFAULT_TRACER) -> List[Curves]:
     """
-    Calculate the perpendicular distance from a point to a line segment.
+    Vectorize several bitmaps (e.g. the colour layers of one design) in one go, letting the
+    backend batch them. Returns the curves of each bitmap, in order; the curves of bitmap i
+    are also stored at paths_paths[i] for the stage cache when given.
     """
-    if start == end:
-        return math.hypot(point.real - start.real, point.imag - start.imag)
-    else:
-        n = abs((end.real - start.real) * (start.imag - point.imag) - 
-                (start.real - point.real) * (end.imag - start.imag))
-        d = math.hypot(end.real - start.real, end.imag - start.imag)
-        return n / d
-
-def rdp(points, epsilon):
-    """
-    Ramer-Douglas-Peucker algorithm to simplify points.
-    """
-    dmax = 0.0
-    index = 0
-    end = len(points) - 1
-    for i in range(1, end):
-        d = perpendicular_distance(points[i], points[0], points[end])
-        if d > dmax:
-            index = i
-            dmax = d
-    if dmax > epsilon:
-        rec_results1 = rdp(points[:index+1], epsilon)
-        rec_results2 = rdp(points[index:], epsilon)
-        result = rec_results1[:-1] + rec_results2
-    else:
-        result = [points[0], points[end]]
-    return result
+    try:
+        bitmaps = [bitmap.read_bytes() if isinstance(bitmap, Path) else bitmap for bitmap in bitmaps]
+        results = TRACING_BACKENDS[tracer].trace_many(bitmaps, token)
+        logging.info(f"Vectorized {len(bitmaps)} bitmaps with {tracer}")
+        traced = [curves for curves, svg in results]
+        for curves, paths_path in zip(traced, paths_paths or []):
+            if paths_path is not None:
+                write_atomic(paths_path, lambda tmp: tmp.write_bytes(pickle.dumps(curves, pickle.HIGHEST_PROTOCOL)))
+        return traced
+    except JobCancelled:
+        logging.info("Vectorizing cancelled")
+        raise
+    except Exception as e:
+        logging.error(f"Error in vectorize_images: {e}")
+        raise e
 
-def simplify_paths(paths, tolerance=2.0):
+def rdp(points: np.ndarray, epsilon: float) -> np.ndarray:
     """
-    Simplify SVG paths by reducing the number of points using RDP algorithm.
+    Ramer-Douglas-Peucker algorithm to simplify an (N, 2) array of points.
+
+    Rather than recursing, all open spans are split together, one level at a time, with the
+    distances of every span computed in one batch. Keeps the same points as the classic
+    recursive version: the first point furthest from a span's chord splits it when its
+    distance exceeds epsilon.
     """
-    simplified_paths = []
-    for path in paths:
-        points = []
-        for segment in path:
-            points.append(segment.start)
-            points.append(segment.end)
-        unique_points = []
-        for pt in points:
-            if not unique_points or (pt.real != unique_points[-1].real or pt.imag != unique_points[-1].imag):
-                unique_points.append(pt)
-        simplified_points = rdp(unique_points, tolerance)
-        simplified_path = SvgPath()
-        for i in range(len(simplified_points)-1):
-            simplified_path.append(Line(simplified_points[i], simplified_points[i+1]))
-        simplified_paths.append(simplified_path)
-    return simplified_paths
+    n = len(points)
+    if n < 2:
+        return np.repeat(points, 2, axis=0)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    x, y = np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1])
+    firsts, lasts = np.array([0]), np.array([n - 1])
+    while len(firsts):
+        open_spans = lasts - firsts >= 2
+        firsts, lasts = firsts[open_spans], lasts[open_spans]
+        if not len(firsts):
+            break
+        # Inner point indices of every span, concatenated, and the span each belongs to
+        lengths = lasts - firsts - 1
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        span = np.repeat(np.arange(len(firsts)), lengths)
+        inner = np.arange(lengths.sum()) - offsets[span] + firsts[span] + 1
+        sx, sy = np.repeat(x[firsts], lengths), np.repeat(y[firsts], lengths)
+        dx, dy = np.repeat(x[lasts] - x[firsts], lengths), np.repeat(y[lasts] - y[firsts], lengths)
+        px, py = x[inner], y[inner]
+        chord = np.hypot(dx, dy)
+        # Spans that close on themselves measure the plain distance to their start point
+        degenerate = chord == 0
+        chord[degenerate] = 1.0
+        distances = np.abs(dx * (sy - py) - (sx - px) * dy) / chord
+        if degenerate.any():
+            distances[degenerate] = np.hypot(px[degenerate] - sx[degenerate], py[degenerate] - sy[degenerate])
+        # First point reaching each span's maximum distance
+        dmax = np.maximum.reduceat(distances, offsets)
+        candidates = np.flatnonzero(distances == dmax[span])
+        candidate_spans = span[candidates]
+        furthest = inner[candidates[np.concatenate(([True], candidate_spans[1:] != candidate_spans[:-1]))]]
+        split = dmax > epsilon
+        index = furthest[split]
+        keep[index] = True
+        firsts, lasts = np.concatenate((firsts[split], index)), np.concatenate((index, lasts[split]))
+    return points[keep]
+
+def radial_distance(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Radial-distance prefilter, O(n) and vectorized: keeps the first point of every
+    tolerance-long stretch of the path, so each dropped point is within tolerance of the
+    last kept one. Distances are measured along the path, which is never shorter than the
+    straight line, so this keeps a few more points than the sequential variant would.
+    The end points are always kept.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    steps = np.hypot(*np.diff(points, axis=0).T)
+    stretch = np.floor(np.concatenate(([0.0], np.cumsum(steps))) / tolerance)
+    keep = np.concatenate(([True], stretch[1:] != stretch[:-1]))
+    keep[-1] = True
+    return points[keep]
+
+def visvalingam_whyatt(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Visvalingam-Whyatt simplification: repeatedly drop the point whose triangle with its
+    neighbours has the smallest area, until every remaining triangle is at least
+    tolerance² in area. Uses a heap with lazy invalidation, so O(n log n).
+    """
+    n = len(points)
+    if n < 3:
+        return np.repeat(points, 2, axis=0) if n == 1 else points
+    threshold = tolerance * tolerance
+    x, y = points[:, 0], points[:, 1]
+    areas = np.full(n, np.inf)
+    areas[1:-1] = 0.5 * np.abs((x[:-2] - x[2:]) * (y[1:-1] - y[:-2]) - (x[:-2] - x[1:-1]) * (y[2:] - y[:-2]))
+    x, y, areas = x.tolist(), y.tolist(), areas.tolist()
+    previous, following = list(range(-1, n - 1)), list(range(1, n + 1))
+    heap = [(area, i) for i, area in enumerate(areas) if area < threshold]
+    heapq.heapify(heap)
+    removed = [False] * n
+
+    def area(i):
+        a, c = previous[i], following[i]
+        return 0.5 * abs((x[a] - x[c]) * (y[i] - y[a]) - (x[a] - x[i]) * (y[c] - y[a]))
+
+    while heap:
+        smallest, i = heapq.heappop(heap)
+        if removed[i] or smallest != areas[i]:
+            continue
+        removed[i] = True
+        a, c = previous[i], following[i]
+        following[a], previous[c] = c, a
+        for neighbour in (a, c):
+            if 0 < neighbour < n - 1:
+                # Never let a neighbour's area drop below what was just removed
+                areas[neighbour] = max(area(neighbour), smallest)
+                if areas[neighbour] < threshold:
+                    heapq.heappush(heap, (areas[neighbour], neighbour))
+    return points[~np.array(removed)]
+
+def radial_rdp(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """RDP after a radial-distance prefilter, which thins dense contours cheaply first."""
+    return rdp(radial_distance(points, tolerance), tolerance)
+
+# Simplifiers by name, each taking an (N, 2) array and a tolerance in path units
+SIMPLIFIERS = {
+    "rdp": rdp,
+    "vw": visvalingam_whyatt,
+    "radial": radial_rdp,
+}
+
+def flatten_curves(curves: Curves, tolerance: float, max_length: Optional[float] = None) -> List[np.ndarray]:
+    """
+    Flatten the curves of a design into polylines, one (N, 2) array per contour.
+
+    All segments are evaluated in one batch. Each is subdivided just enough to stay within
+    tolerance of the curve (Wang's formula), and, with max_length, enough that no piece's
+    control polygon is longer than that.
+    """
+    if not len(curves.controls):
+        return []
+    controls = curves.controls[..., 0] + 1j * curves.controls[..., 1]
+    p0, p1, p2, p3 = controls.T
+
+    # Wang's formula for a cubic: n = ceil(sqrt(3 * 2 / 8 * max |second difference| / tolerance))
+    curvature = np.maximum(np.abs(p0 - 2 * p1 + p2), np.abs(p1 - 2 * p2 + p3))
+    counts = np.ceil(np.sqrt(0.75 * curvature / max(tolerance, 1e-6)))
+    if max_length:
+        polygon = np.abs(p1 - p0) + np.abs(p2 - p1) + np.abs(p3 - p2)
+        counts = np.maximum(counts, np.ceil(polygon / max_length))
+    counts = np.clip(counts, 1, 1000).astype(int)
+
+    # Evaluate every segment at t = 1/n, 2/n ... 1, all segments at once
+    segment_index = np.repeat(np.arange(len(controls)), counts)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    t = (np.arange(counts.sum()) - offsets[segment_index] + 1) / counts[segment_index]
+    mt = 1 - t
+    points = (mt ** 3 * p0[segment_index] + 3 * mt ** 2 * t * p1[segment_index] +
+              3 * mt * t ** 2 * p2[segment_index] + t ** 3 * p3[segment_index])
+    points[offsets + counts - 1] = p3  # land exactly on the segment ends
+
+    contours = []
+    for first, last in zip(curves.offsets[:-1].tolist(), curves.offsets[1:].tolist()):
+        contour = np.concatenate(([p0[first]], points[offsets[first]:offsets[last - 1] + counts[last - 1]]))
+        contour = contour[np.concatenate(([True], contour[1:] != contour[:-1]))]
+        contours.append(np.column_stack((contour.real, contour.imag)))
+    return contours
+
+def limit_stitch_length(points: np.ndarray, max_length: float) -> np.ndarray:
+    """
+    Split every edge longer than max_length into equal pieces, so no stitch exceeds it.
+    """
+    if len(points) < 2 or not max_length:
+        return points
+    steps = np.diff(points, axis=0)
+    pieces = np.maximum(1, np.ceil(np.hypot(steps[:, 0], steps[:, 1]) / max_length)).astype(int)
+    if (pieces == 1).all():
+        return points
+    edge = np.repeat(np.arange(len(steps)), pieces)
+    offsets = np.concatenate(([0], np.cumsum(pieces)[:-1]))
+    t = (np.arange(pieces.sum()) - offsets[edge] + 1) / pieces[edge]
+    return np.concatenate((points[:1], points[edge] + steps[edge] * t[:, None]))
+
+def simplify_paths(contours: List[np.ndarray], tolerance=2.0, token: Optional[CancellationToken] = None,
+                   simplifier: str = DEFAULT_SIMPLIFIER, max_length: Optional[float] = None) -> StitchPlan:
+    """
+    Simplify flattened contours with one of the SIMPLIFIERS, split stitches longer than
+    max_length back up, and lay the result out as a stitch plan.
+    """
+    simplify = SIMPLIFIERS[simplifier]
+    simplified = []
+    for points in contours:
+        if token:
+            token.check()
+        simplified.append(limit_stitch_length(simplify(points, tolerance), max_length))
+    return StitchPlan.from_contours(simplified)
 
 
 
-def generate_stitches(svg_path: Path, settings: Dict) -> EmbPattern:
+# ---------------------
+# Running Stitches
+# ---------------------
+
+def resample_running(plan: StitchPlan, length: float, min_length: float, max_length: float,
+                     corner_angle: float = 30.0) -> StitchPlan:
+    """
+    Resample every contour of a plan into running stitches of about length, all contours in
+    one np.interp call over their arc lengths laid end to end.
+
+    Contour ends and corners (turns sharper than corner_angle degrees) stay needle points. Each
+    stretch between them is split into equal stitches, as close to length as min_length and
+    max_length allow; max_length wins when a stretch is too short for both.
+    """
+    if not len(plan):
+        return plan
+    points = plan.coords.astype(np.float64)
+    contour = np.repeat(np.arange(len(plan.offsets) - 1), np.diff(plan.offsets))
+    # Drop repeated points, they have no direction
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (contour[1:] != contour[:-1]) | (points[1:] != points[:-1]).any(axis=1)
+    points, contour = points[keep], contour[keep]
+    first = np.concatenate(([True], contour[1:] != contour[:-1]))
+    last = np.concatenate((contour[1:] != contour[:-1], [True]))
+
+    # Arc length axis with a unit gap between contours, so it keeps increasing
+    steps = np.diff(points, axis=0)
+    lengths = np.where(last[:-1], 1.0, np.hypot(*steps.T))
+    axis = np.concatenate(([0.0], np.cumsum(lengths)))
+
+    # Needle points that stay: contour ends and corners
+    incoming, outgoing = steps[:-1], steps[1:]
+    turn = (incoming * outgoing).sum(axis=1) / np.maximum(lengths[:-1] * lengths[1:], 1e-12)
+    anchors = first | last
+    anchors[1:-1] |= ~first[1:-1] & ~last[1:-1] & (turn < np.cos(np.radians(corner_angle)))
+    anchor = np.flatnonzero(anchors)
+
+    # Stretches between consecutive anchors of the same contour, and their stitch counts
+    stretch = anchor[:-1][~last[anchor[:-1]]]
+    stretch_end = anchor[np.searchsorted(anchor, stretch) + 1]
+    span = axis[stretch_end] - axis[stretch]
+    counts = np.maximum(np.rint(span / length), 1)
+    counts = np.minimum(counts, np.maximum(np.floor(span / min_length), 1))
+    counts = np.maximum(counts, np.ceil(span / max_length)).astype(np.int64)
+
+    owner = np.repeat(np.arange(len(stretch)), counts)
+    step_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.concatenate((axis[stretch][owner] + span[owner] * step_index / counts[owner], axis[last]))
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    coords = np.column_stack((np.interp(positions, axis, points[:, 0]), np.interp(positions, axis, points[:, 1])))
+
+    sizes = np.bincount(contour[stretch], weights=counts, minlength=len(plan.offsets) - 1).astype(np.int64)
+    sizes += np.bincount(contour[last], minlength=len(plan.offsets) - 1)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    return StitchPlan(np.rint(coords).astype(np.int32), np.full(len(coords), STITCH, dtype=np.uint8), offsets)
+
+# ---------------------
+# Fill Stitches
+# ---------------------
+
+def scanline_segments(contours: List[np.ndarray], spacing: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cut closed contours with horizontal rows at y = (k + 0.5) * spacing, all rows at once:
+    every edge is repeated once per row it crosses, and the crossings of each row, sorted
+    by x, pair up into inside segments (even-odd rule, so holes stay empty).
+
+    Returns the row number, start x and end x of every segment, sorted by row and x.
+    """
+    points = np.concatenate(contours)
+    # Edges join consecutive points of the same contour
+    inner = np.ones(len(points) - 1, dtype=bool)
+    inner[np.cumsum([len(contour) for contour in contours])[:-1] - 1] = False
+    a, b = points[:-1][inner], points[1:][inner]
+
+    # Rows in [low, high) of each edge, so shared vertices and horizontal edges count once
+    low, high = np.minimum(a[:, 1], b[:, 1]), np.maximum(a[:, 1], b[:, 1])
+    first = np.ceil(low / spacing - 0.5).astype(np.int64)
+    counts = np.maximum(np.ceil(high / spacing - 0.5).astype(np.int64) - first, 0)
+    edge = np.repeat(np.arange(len(a)), counts)
+    row = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = ((row + 0.5) * spacing - a[edge, 1]) / (b[edge, 1] - a[edge, 1])
+    x = a[edge, 0] + t * (b[edge, 0] - a[edge, 0])
+
+    order = np.lexsort((x, row))
+    row, x = row[order], x[order]
+    return row[0::2], x[0::2], x[1::2]
+
+def chain_segments(rows: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Group row segments into blocks that can be sewn back and forth in one go: a segment
+    continues the block of the segment above it when each overlaps only the other.
+    Returns the block number of every segment.
+    """
+    chains = np.empty(len(rows), dtype=np.int64)
+    groups = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1], [True])))
+    count = 0
+    previous = None
+    for first, last in zip(groups[:-1].tolist(), groups[1:].tolist()):
+        block = np.zeros(last - first, dtype=bool)
+        if previous is not None and rows[previous[0]] == rows[first] - 1:
+            above_starts, above_ends = starts[previous[0]:previous[1]], ends[previous[0]:previous[1]]
+            # Segments are sorted and disjoint within a row, so overlaps are index ranges
+            low = np.searchsorted(above_ends, starts[first:last], "right")
+            high = np.searchsorted(above_starts, ends[first:last], "left")
+            below_low = np.searchsorted(ends[first:last], above_starts, "right")
+            below_high = np.searchsorted(starts[first:last], above_ends, "left")
+            single = (high - low == 1)
+            block = single & (below_high - below_low == 1)[np.minimum(low, len(above_starts) - 1)]
+            chains[first:last][block] = chains[previous[0]:previous[1]][low[block]]
+        fresh = ~block
+        chains[first:last][fresh] = np.arange(count, count + fresh.sum())
+        count += int(fresh.sum())
+        previous = (first, last)
+    return chains
+
+def tatami_fill(contours: List[np.ndarray], angle: float = 45.0, spacing: float = 4.0,
+                stitch_length: float = 40.0, stagger: int = 3, max_stitches: Optional[int] = None) -> StitchPlan:
+    """
+    Fill the regions enclosed by closed contours (holes excluded) with tatami stitches: rows
+    spacing apart at angle degrees, sewn back and forth in blocks, with needle points every
+    stitch_length along a row and shifted by stitch_length / stagger from one row to the next.
+    Raises ValueError, before placing any stitch, when the fill would have more than max_stitches.
+    """
+    closed = [contour for contour in contours if len(contour) > 2 and (contour[0] == contour[-1]).all()]
+    if not closed:
+        return StitchPlan.from_contours([])
+    # Work in a frame where the rows are horizontal
+    theta = np.radians(angle)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    rows, starts, ends = scanline_segments([contour @ rotation for contour in closed], spacing)
+    if not len(rows):
+        return StitchPlan.from_contours([])
+    chains = chain_segments(rows, starts, ends)
+
+    # Sew blocks one after the other, top to bottom, every other row right to left
+    order = np.lexsort((rows, chains))
+    rows, starts, ends, chains = rows[order], starts[order], ends[order], chains[order]
+    chain_firsts = np.flatnonzero(np.concatenate(([True], chains[1:] != chains[:-1])))
+    rank = np.arange(len(rows)) - np.repeat(chain_firsts, np.diff(np.append(chain_firsts, len(rows))))
+    backwards = rank % 2 == 1
+
+    # Needle points on the row's stitch grid, kept a quarter stitch away from the ends
+    phase = (rows % stagger) * stitch_length / stagger
+    margin = stitch_length / 4
+    first = np.floor((starts + margin - phase) / stitch_length).astype(np.int64) + 1
+    last = np.ceil((ends - margin - phase) / stitch_length).astype(np.int64) - 1
+    sizes = np.maximum(last - first + 1, 0) + 2
+    if max_stitches is not None and sizes.sum() > max_stitches:
+        raise ValueError(f"The fill would need {sizes.sum()} stitches, more than the {max_stitches} allowed; "
+                         f"use a larger fill_spacing")
+    segment = np.repeat(np.arange(len(rows)), sizes)
+    offsets = np.cumsum(sizes) - sizes
+    local = np.arange(sizes.sum()) - offsets[segment]
+    local = np.where(backwards[segment], sizes[segment] - 1 - local, local)
+    x = phase[segment] + (first[segment] + local - 1) * stitch_length
+    x = np.where(local == 0, starts[segment], np.where(local == sizes[segment] - 1, ends[segment], x))
+    y = (rows[segment] + 0.5) * spacing
+
+    points = np.column_stack((x, y)) @ rotation.T
+    chain_offsets = np.append(offsets[chain_firsts], len(points))
+    return StitchPlan(np.rint(points).astype(np.int32), np.full(len(points), STITCH, dtype=np.uint8), chain_offsets)
+
+# ---------------------
+# Satin Columns
+# ---------------------
+
+def resample_closed(contours: List[np.ndarray], spacing: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Evenly spaced samples around every closed contour, all contours in one np.interp call:
+    their arc lengths are laid end to end on one axis. Returns the (S, 2) samples, the
+    sample offsets per contour and the arc length of each sample along its contour.
+    """
+    lengths = np.array([len(contour) for contour in contours])
+    points = np.concatenate(contours)
+    steps = np.hypot(*np.diff(points, axis=0).T)
+    steps[np.cumsum(lengths)[:-1] - 1] = 1.0  # a unit gap between contours keeps the axis increasing
+    axis = np.concatenate(([0.0], np.cumsum(steps)))
+    starts = axis[np.cumsum(lengths) - lengths]
+    perimeters = axis[np.cumsum(lengths) - 1] - starts
+    counts = np.maximum(np.ceil(perimeters / spacing), 3).astype(np.int64)
+    owner = np.repeat(np.arange(len(contours)), counts)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    arc = (np.arange(counts.sum()) - offsets[owner]) * (perimeters / counts)[owner]
+    samples = np.column_stack((np.interp(starts[owner] + arc, axis, points[:, 0]),
+                               np.interp(starts[owner] + arc, axis, points[:, 1])))
+    return samples, offsets, arc
+
+def satin_columns(contours: List[np.ndarray], spacing: float = 4.0, max_width: float = 70.0,
+                  raster_step: float = 2.0, min_run: int = 5) -> StitchPlan:
+    """
+    Sew the narrow parts of a design as satin columns and the rest as outlines.
+
+    Every closed contour is sampled spacing apart (the rail), and from each sample a ray is
+    cast inwards across a raster of the filled design to find the opposite rail. Samples
+    whose opposite rail is within max_width pair up with it; of the two rails of a column,
+    the one with the lower sample index sews it, zig-zagging between the pairs. Stretches
+    with no opposite rail in reach keep their original outline points.
+    """
+    closed = [contour for contour in contours if len(contour) > 2 and (contour[0] == contour[-1]).all()]
+    outlines = [contour for contour in contours if not (len(contour) > 2 and (contour[0] == contour[-1]).all())]
+    if not closed:
+        return StitchPlan.from_contours(outlines)
+    samples, offsets, arc = resample_closed(closed, spacing)
+    owner = np.repeat(np.arange(len(closed)), np.diff(offsets))
+
+    # Raster of the filled design (even-odd, like the traced bitmap), with a border wide
+    # enough that no ray leaves it
+    reach = int(np.ceil(spacing / raster_step / 2)) + 1
+    border = max_width + (reach + 4) * raster_step
+    origin = np.concatenate(closed).min(axis=0) - border
+    shape = (np.ceil((np.concatenate(closed).max(axis=0) + border - origin) / raster_step) + 1).astype(int)
+    mask = np.zeros((shape[1], shape[0]), dtype=bool)
+    cv2.fillPoly(mask.view(np.uint8), [np.rint((contour - origin) / raster_step).astype(np.int32) for contour in closed], 1)
+
+    def pixel(positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        pixels = np.rint((positions - origin) / raster_step).astype(np.intp)
+        return pixels[..., 1], pixels[..., 0]
+
+    def inside(positions: np.ndarray) -> np.ndarray:
+        return mask[pixel(positions)]
+
+    # Normals from the neighbouring samples on the same contour, turned to face inwards
+    index = np.arange(len(samples))
+    following = np.where(index + 1 == offsets[owner + 1], offsets[owner], index + 1)
+    preceding = np.where(index == offsets[owner], offsets[owner + 1] - 1, index - 1)
+    tangent = samples[following] - samples[preceding]
+    normal = np.column_stack((-tangent[:, 1], tangent[:, 0])) / np.maximum(np.hypot(*tangent.T), 1e-9)[:, None]
+    probe = np.arange(1, 4) * raster_step
+    outwards = (inside(samples[:, None] - normal[:, None] * probe[:, None]).sum(axis=1) >
+                inside(samples[:, None] + normal[:, None] * probe[:, None]).sum(axis=1))
+    normal[outwards] *= -1
+
+    # March every ray at once: the opposite rail is where the ray leaves the shape again
+    t = np.arange(0.5, max_width + raster_step, raster_step)
+    hits = inside(samples[:, None] + normal[:, None] * t[:, None])
+    entered = hits.argmax(axis=1)
+    left = ~hits & (np.arange(len(t)) > entered[:, None])
+    exits = left.argmax(axis=1)
+    narrow = hits.any(axis=1) & left.any(axis=1) & (t[entered] <= 2 * raster_step) & (t[exits] <= max_width)
+    opposite = samples + normal * (t[exits] - raster_step / 4)[:, None]
+
+    # Match every pair to the nearest sample on the other rail, searching the raster around
+    # the ray's end for sample pixels; the rail with the lower sample index sews the column
+    sample_at = np.full(mask.shape, -1, dtype=np.int64)
+    sample_at[pixel(samples)] = index
+    window = np.arange(-reach, reach + 1)
+    rows, cols = pixel(opposite)
+    candidates = sample_at[rows[:, None, None] + window[:, None], cols[:, None, None] + window].reshape(len(samples), -1)
+    distances = np.hypot(*(samples[candidates] - opposite[:, None]).transpose(2, 0, 1))
+    distances[candidates < 0] = np.inf
+    partner = candidates[index, distances.argmin(axis=1)]
+    narrow &= partner >= 0
+    # 0: outline, 1: sews a satin column, 2: sewn by the other rail's column
+    kind = np.where(narrow, np.where(index < partner, 1, 2), 0)
+
+    columns = []
+    for number, contour in enumerate(closed):
+        first, last = offsets[number], offsets[number + 1]
+        kinds = kind[first:last]
+        if not kinds.any():
+            columns.append(contour)
+            continue
+        # Start at a change of kind, so no run wraps around the contour's start
+        changes = np.flatnonzero(kinds != np.roll(kinds, 1))
+        shift = changes[0] if len(changes) else 0
+        order = first + np.roll(np.arange(last - first), -shift)
+        perimeter = np.hypot(*np.diff(contour, axis=0).T).sum()
+        rail_arc = np.where(np.arange(len(order)) < len(order) - shift, arc[order], arc[order] + perimeter)
+        vertex_arc = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(contour, axis=0).T))))
+        vertex_arc = np.concatenate((vertex_arc[:-1], vertex_arc[:-1] + perimeter))
+        vertices = np.concatenate((contour[:-1], contour[:-1]))
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(kind[order])) + 1, [len(order)]))
+        # Consecutive runs of the same role join into one piece. Runs of a few samples, where
+        # the pairing flickers (corners, rail ends), keep the role of the piece around them.
+        pieces, role, stitched_outline = [], "start", False
+        for run_first, run_last in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            run = order[run_first:run_last]
+            run_kind = kind[run[0]]
+            if len(run) < min_run and role != "start":
+                run_role = role
+            else:
+                run_role = {0: "outline", 1: "column", 2: None}[run_kind]
+            if run_role != role and pieces:
+                columns.append(np.concatenate(pieces))
+                pieces = []
+            role = run_role
+            if role == "column" and run_kind:
+                pieces.append(np.stack((samples[run], opposite[run]), axis=1).reshape(-1, 2))
+                stitched_outline = False
+            elif role is not None:
+                # The original outline over this stretch, up to the next run's first sample
+                end = order[run_last] if run_last < len(order) else order[0]
+                high = rail_arc[run_last] if run_last < len(order) else rail_arc[0] + perimeter
+                between = (vertex_arc > rail_arc[run_first]) & (vertex_arc < high)
+                if pieces and stitched_outline:
+                    pieces[-1] = pieces[-1][:-1]  # the previous stretch ended where this one starts
+                pieces.append(np.concatenate(([samples[run[0]]], vertices[between], [samples[end]])))
+                stitched_outline = True
+        if pieces:
+            columns.append(np.concatenate(pieces))
+    return StitchPlan.from_contours(columns + outlines)
+
+def load_curves(svg_path) -> Curves:
+    """
+    Parse the curves of an SVG file, or load them from the stage cache if they were parsed before.
+    Already parsed curves are passed through.
+    """
+    if isinstance(svg_path, Curves):
+        return svg_path
+    if svg_path.suffix == ".pkl":
+        with open(svg_path, "rb") as f:
+            return pickle.load(f)
+    return parse_potrace_svg(Path(svg_path).read_text())
+
+def generate_stitches(svg_path, settings: Dict, token: Optional[CancellationToken] = None,
+                      long_edge: Optional[int] = None) -> StitchPlan:
     """
-    Convert SVG paths to embroidery stitches based on user-defined settings.
+    Convert traced curves to embroidery stitches based on user-defined settings.
     
     Args:
-        svg_path (Path): Path to the SVG file.
+        svg_path: Curves from vectorize_image, their stage cache file, or an SVG file.
         settings (Dict): Dictionary containing settings like stitch_density and stitch_type.
+        token (CancellationToken, optional): Checked between paths so cancelled jobs stop early.
+        long_edge (int, optional): Long edge the curves were traced at; defaults to that of
+            the detail level in settings.
     
     Returns:
-        EmbPattern: The generated embroidery pattern.
+        StitchPlan: The generated stitches.
     """
     try:
         # Parse SVG paths
-        paths, attributes = svg2paths(str(svg_path))
-        logging.debug(f"Parsed {len(paths)} paths from {svg_path}")
-
-        # Simplify paths based on stitch density
-        tolerance = settings.get("stitch_density", 2.0)
-        simplified_paths = simplify_paths(paths, tolerance=tolerance)
-        logging.debug(f"Simplified paths with tolerance {tolerance}")
-
-        # Create a new embroidery pattern
-        pattern = EmbPattern()
-
-        # Convert SVG paths to embroidery stitches
-        for path in simplified_paths:
-            for segment in path:
-                start = segment.start
-                end = segment.end
-                stitch_type = settings.get("stitch_type", "normal")
-
-                if stitch_type == "jump":
-                    # Use JUMP command for non-stitch movements
-                    pattern.add_stitch_absolute(JUMP, end.real, end.imag)
-                else:
-                    # Use STITCH command for regular stitching
-                    pattern.add_stitch_absolute(STITCH, end.real, end.imag)
+        curves = load_curves(svg_path)
+        logging.debug(f"Loaded {len(curves)} contours")
 
-        # Mark the end of the pattern
-        pattern.add_command(END)  # Correct command to end the pattern
+        # Finer traces come in more pattern units per pixel; bring them back to the standard size
+        scale = DETAIL_LEVELS["standard"] / (long_edge or DETAIL_LEVELS[settings.get("detail", "standard")])
+        if scale != 1:
+            curves = Curves(curves.controls * scale, curves.offsets)
 
-        logging.info(f"Stitches successfully generated from {svg_path}")
-        return pattern
+        # Flatten the curves and simplify the result based on stitch density
+        tolerance = settings.get("stitch_density", 2.0)
+        simplifier = settings.get("simplifier", DEFAULT_SIMPLIFIER)
+        contours = flatten_curves(curves, tolerance)
+        plan = simplify_paths(contours, tolerance=tolerance, token=token,
+                              simplifier=simplifier, max_length=MAX_STITCH_LENGTH)
+        logging.debug(f"Flattened into {len(contours)} contours, simplified with {simplifier}, tolerance {tolerance}")
+
+        if settings.get("stitch_type", "normal") == "fill":
+            # Fill the shapes the contours enclose instead of sewing the outlines
+            plan = tatami_fill(list(plan.contours()), angle=settings.get("fill_angle", 45.0),
+                               spacing=settings.get("fill_spacing", 4.0),
+                               stitch_length=FILL_STITCH_LENGTH, stagger=FILL_STAGGER,
+                               max_stitches=MAX_FILL_STITCHES)
+            logging.debug(f"Tatami fill of {len(plan)} stitches in {len(plan.offsets) - 1} blocks")
+        elif settings.get("stitch_type", "normal") == "satin":
+            # Zig-zag across the narrow parts instead of sewing both of their outlines
+            plan = satin_columns(list(plan.contours()), spacing=settings.get("satin_spacing", 4.0),
+                                 max_width=SATIN_MAX_WIDTH)
+            logging.debug(f"Satin columns and outlines of {len(plan)} stitches in {len(plan.offsets) - 1} pieces")
+        else:
+            # Even running stitches instead of whatever vertices the simplifier left
+            running_length = settings.get("running_length", RUNNING_STITCH_LENGTH)
+            plan = resample_running(plan, running_length, RUNNING_MIN_LENGTH,
+                                    max(RUNNING_MAX_LENGTH, running_length), CORNER_ANGLE)
+            logging.debug(f"Resampled into {len(plan)} running stitches of about {running_length / 10:.1f} mm")
+
+        # Sew the contours in an order that keeps the needle's travel between them short
+        plan, travel_before, travel_after = order_contours(plan, TRAVEL_2OPT_SECONDS)
+        if travel_before:
+            logging.info(f"Contour ordering cut travel from {travel_before / 10:.0f} mm to {travel_after / 10:.0f} mm "
+                         f"({100 * (1 - travel_after / travel_before):.0f}% saved)")
+
+        if settings.get("stitch_type", "normal") == "jump":
+            # Use JUMP command for non-stitch movements
+            plan.commands[:] = JUMP
+        else:
+            # Travel stitches, jumps or trims between the contours, by how far apart they are
+            plan, moves = connect_contours(plan, TRAVEL_STITCH_MAX, TRIM_MIN_LENGTH)
+            logging.debug(f"Connected contours with {moves['travel']} travel stitches, "
+                          f"{moves['jump']} jumps and {moves['trim']} trims")
+
+        logging.info(f"{len(plan)} stitches successfully generated from {len(curves)} contours")
+        return plan
+    except JobCancelled:
+        raise
     except Exception as e:
         logging.error(f"Error in generate_stitches: {e}")
         raise e
 
 
-def save_dst(pattern: EmbPattern, output_filename: str) -> Path:
+def save_dst(plan: StitchPlan, output_filename: str) -> Path:
     """
-    Save the embroidery pattern to a DST file.
+    Save the stitch plan to a DST file.
     """
     try:
         dst_path = OUTPUT_DIR / output_filename
-        write_dst(pattern, str(dst_path))
+        data = encode_dst(plan) if NATIVE_DST_ENCODER else None
+        if data is None:
+            write_dst(plan.to_pattern(), str(dst_path))
+        else:
+            dst_path.write_bytes(data)
         logging.info(f"DST file saved to {dst_path}")
         return dst_path
     except Exception as e:
         logging.error(f"Error in save_dst: {e}")
         raise e
 
-async def digitize_image(client_id: str, image_path: Path, settings: Dict):
+async def digitize_image(job: Dict):
     """
     Full digitization pipeline: preprocess, vectorize, generate stitches, and save DST.
-    Sends updates to the client via WebSocket.
+    In colour mode the image is split into one layer per colour; the layers are traced in
+    one batch and stitched in parallel.
+    Each stage runs in the worker pool; updates are sent to the client via WebSocket
+    and the final state is recorded in the job store.
     """
-    try:
-        await manager.send_message(client_id, "Preprocessing image...")
-        processed_image = await preprocess_image(image_path)
-
-        await manager.send_message(client_id, "Vectorizing image...")
-        svg_image = vectorize_image(processed_image)
+    client_id = job["client_id"]
+    image_path = Path(job["upload_path"])
+    settings = job["settings"]
+    tracer = settings.get("tracer", DEFAULT_TRACER)
+    # Jobs queued before the traced size was recorded use their detail level's
+    long_edge = job["long_edge"] or DETAIL_LEVELS[settings.get("detail", "standard")]
+    data = upload_buffers.pop(job["id"])  # None after a restart, or for large uploads
+    token = CancellationToken(job["id"])
+
+    async def run_stage(stage: str, func, *args):
+        # Don't start another stage for a job nobody wants any more
+        token.check()
+        # Time every stage so admission control can estimate throughput
+        result, seconds = await stage_runner.run(stage, func, *args)
+        admission.record(stage, job["pixels"], seconds)
+        return result
+
+    async def run_layers(stage: str, func, calls: List[Tuple]):
+        # One task per colour layer, all handed to the pool at once. The stage is timed by the
+        # worker time of all layers together, like the worker-seconds admission estimates in.
+        # The first layer to fail cancels the others (their workers are replaced rather than
+        # left computing for a dead job), and the group only exits once every layer has returned
+        token.check()
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(stage_runner.run(stage, func, *args)) for args in calls]
+        except BaseExceptionGroup as e:
+            # Fail the job the way a single stage would
+            raise e.exceptions[0]
+        results = [task.result() for task in tasks]
+        admission.record(stage, job["pixels"], sum(seconds for result, seconds in results))
+        return [result for result, seconds in results]
 
-        await manager.send_message(client_id, "Generating stitches...")
-        pattern = generate_stitches(svg_image, settings)
+    try:
+        bitmap_path = paths_path = None
+        if job["content_hash"] and stage_cache.enabled:
+            # Reuse whatever earlier jobs on the same image already computed
+            bitmap_key = stage_cache.bitmap_key(job["content_hash"], long_edge)
+            bitmap_path = stage_cache.path(bitmap_key, ".pbm")
+            paths_path = stage_cache.path(stage_cache.vector_key(bitmap_key, tracer), ".pkl")
+        preview_path = None
+        if SAVE_PREVIEWS or DEBUG_PERSIST_ARTIFACTS:
+            preview_path = PROCESSED_DIR / f"{image_path.stem}_processed.svg"
+
+        if settings.get("color_mode", "monochrome") == "color":
+            # One layer per thread colour, traced together and stitched side by side across the
+            # pool, so the stitching time follows the largest layer rather than the colour count
+            layers_path = None
+            if job["content_hash"] and stage_cache.enabled:
+                layers_key = stage_cache.layers_key(job["content_hash"], settings.get("colors", COLOR_COUNT), long_edge)
+                layers_path = stage_cache.path(layers_key, ".pkl")
+            if layers_path and stage_cache.lookup(layers_path):
+                layers = pickle.loads(await asyncio.to_thread(layers_path.read_bytes))
+            else:
+                await manager.send_message(client_id, "Quantizing colours...", job["id"])
+                layers = await run_stage("preprocess", quantize_image, image_path,
+                                         settings.get("colors", COLOR_COUNT), token, long_edge, data)
+                if layers_path:
+                    layers_data = pickle.dumps(layers, pickle.HIGHEST_PROTOCOL)
+                    await asyncio.to_thread(write_atomic, layers_path, lambda tmp: tmp.write_bytes(layers_data))
+
+            paths, untraced = [], []
+            for index, (color, bitmap) in enumerate(layers):
+                layer_path = None
+                if layers_path:
+                    layer_path = stage_cache.path(stage_cache.vector_key(f"{layers_key}/{index}", tracer), ".pkl")
+                if layer_path and stage_cache.lookup(layer_path):
+                    paths.append(layer_path)
+                else:
+                    paths.append(None)
+                    untraced.append((index, bitmap, layer_path))
+            if untraced:
+                # Traced as one batch, so potrace starts once per job rather than once per layer
+                await manager.send_message(client_id, f"Vectorizing {len(untraced)} colour layers...", job["id"])
+                traced = await run_stage("vectorize", vectorize_images,
+                                         [bitmap for index, bitmap, layer_path in untraced], token,
+                                         [layer_path for index, bitmap, layer_path in untraced], tracer)
+                for (index, bitmap, layer_path), curves in zip(untraced, traced):
+                    paths[index] = curves
+            if preview_path and layers:
+                magic, width, height = layers[0][1].split(maxsplit=3)[:3]
+                svg = await asyncio.to_thread(lambda: layers_to_svg(
+                    [(color, load_curves(path)) for (color, bitmap), path in zip(layers, paths)], int(width), int(height)
+                ))
+                await asyncio.to_thread(preview_path.write_text, svg)
+
+            await manager.send_message(client_id, "Generating stitches...", job["id"])
+            plans = await run_layers("stitches", generate_stitches, [(path, settings, token, long_edge) for path in paths])
+            plan = merge_layers(plans)
+            logging.info(f"Merged {len(plans)} colour layers into {len(plan)} stitches")
+        else:
+            if paths_path and stage_cache.lookup(paths_path):
+                logging.info(f"Job {job['id']} reuses traced paths {paths_path.name}")
+                if preview_path and paths_path.with_suffix(".svg").exists():
+                    link_file(paths_path.with_suffix(".svg"), preview_path)
+                paths = paths_path
+            else:
+                if bitmap_path and stage_cache.lookup(bitmap_path):
+                    bitmap = bitmap_path
+                else:
+                    await manager.send_message(client_id, "Preprocessing image...", job["id"])
+                    bitmap = await run_stage("preprocess", preprocess_image, image_path, token, long_edge, data)
+                    if bitmap_path:
+                        await asyncio.to_thread(write_atomic, bitmap_path, lambda tmp: tmp.write_bytes(bitmap))
+
+                await manager.send_message(client_id, "Vectorizing image...", job["id"])
+                paths = await run_stage("vectorize", vectorize_image, bitmap, token, preview_path, paths_path, tracer)
+
+            await manager.send_message(client_id, "Generating stitches...", job["id"])
+            plan = await run_stage("stitches", generate_stitches, paths, settings, token, long_edge)
+
+        await manager.send_message(client_id, "Saving DST file...", job["id"])
+        dst_file = await run_stage("save", save_dst, plan, job["output_filename"])
+
+        job_store.finish(job["id"])
+        if job["cache_key"]:
+            try:
+                result_cache.put(job["cache_key"], dst_file, preview_path)
+            except Exception as e:
+                logging.warning(f"Could not cache result of job {job['id']}: {e}")
+        await manager.send_message(client_id, "Digitization complete.", job["id"])
+
+    except asyncio.CancelledError:
+        # Server shutting down; the job stays 'running' and is requeued on the next start
+        raise
+    except JobCancelled:
+        logging.info(f"Digitization of job {job['id']} stopped after cancellation")
+        await manager.send_message(client_id, "Digitization cancelled.", job["id"])
+    except Exception as e:
+        job_store.fail(job["id"], str(e))
+        await manager.send_message(client_id, f"Error during digitization: {str(e)}", job["id"])
+        logging.error(f"Error in digitize_image: {e}")
+    finally:
+        token.clear()
+        if stage_cache.enabled:
+            await asyncio.to_thread(stage_cache.evict)
 
-        await manager.send_message(client_id, "Saving DST file...")
-        output_filename = image_path.stem + ".dst"
-        dst_file = save_dst(pattern, output_filename)
+# ---------------------
+# Lifecycle Events
+# ---------------------
 
-        await manager.send_message(client_id, "Digitization complete.")
+@app.on_event("startup")
+async def startup():
+    stage_runner.start()
+    dispatcher.start()
 
-    except Exception as e:
-        await manager.send_message(client_id, f"Error during digitization: {str(e)}")
-        logging.error(f"Error in digitize_image: {e}")
+@app.on_event("shutdown")
+async def shutdown():
+    await dispatcher.stop()
+    stage_runner.shutdown()
 
 # ---------------------
 # API Endpoints
 # ---------------------
 
 @app.post("/upload/", response_model=UploadResponse)
-async def upload_image(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    client_id: str = Form(...),
-    stitch_density: int = Form(default=2),
-    stitch_type: str = Form(default="normal")
-):
+async def upload_image(request: Request, x_api_key: Optional[str] = Header(default=None)):
     """
     Endpoint to upload an image and receive the embroidered DST file.
+    The multipart form carries the fields of UploadForm and the image as `file`. The upload
+    is parsed as it arrives: when the fields come first, the image is accepted or refused
+    before any of it is written anywhere; fields sent after it are honoured too, but then the
+    image is kept on disk until they are in.
+    Batch integrations should send priority=bulk so interactive users keep a fast lane.
+    fill_angle (degrees) and fill_spacing (0.1 mm) set the rows of the "fill" stitch type,
+    satin_spacing (0.1 mm) the density of the "satin" one, and running_length (0.1 mm) the
+    stitch length of the others. color_mode=color sews the image in up to `colors` colours
+    (the background is one of them, and isn't sewn) instead of a single one. detail=high traces the image at a much higher resolution
+    (its own, up to HIGH_DETAIL_LONG_EDGE) for fine artwork and large scans.
     """
     # Ensure directories exist
     ensure_directories()
-    
-    logging.info(f"Received upload request - client_id: {client_id}, stitch_density: {stitch_density}, stitch_type: {stitch_type}")
 
+    # Refuse bodies that announce more than the limit (plus room for the fields) before reading them
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > MAX_UPLOAD_BYTES + 64 * 1024:
+        raise HTTPException(status_code=400, detail="File too large. Max size is 10MB.")
+
+    memory_max = UPLOAD_MEMORY_MAX_MB * 1024 * 1024
+    fields: Dict[str, str] = {}
+    form: Optional[UploadForm] = None  # from the fields sent before the file, if any
+    late_fields = False
+    file_seen = False
+    admitted = None  # (pixels, lane) the reservation was made for
+    partial_path: Optional[Path] = None
+    buffer = None  # the .part file, once the upload is admitted (or while its fields are awaited)
+    held: List[bytes] = []  # the start of the file, and all of it while it is small
+    size = 0
+    hasher = hashlib.sha256()
+    dimensions = None
+    reservation: Optional[str] = None
+    rejection: Optional[HTTPException] = None
     try:
-        # Validate file type
-        if file.content_type not in ["image/png", "image/jpeg", "image/jpg"]:
-            raise HTTPException(status_code=400, detail="Invalid file type. Only PNG and JPEG are supported.")
-
-        # Limit file size (10 MB)
-        max_file_size = 10 * 1024 * 1024
-        contents = await file.read()
-        if len(contents) > max_file_size:
-            raise HTTPException(status_code=400, detail="File too large. Max size is 10MB.")
-        await file.seek(0)
-
-        # Generate unique filename and save file
-        unique_filename = get_unique_filename(file.filename)
-        upload_path = UPLOAD_DIR / unique_filename
-        
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async for kind, name, value in MultipartStream(request).events():
+            if kind == "field":
+                fields[name] = value
+                late_fields = file_seen
+                continue
+            if kind == "file":
+                if file_seen or name != "file":
+                    raise HTTPException(status_code=400, detail="Send one image, in the form field 'file'.")
+                file_seen = True
+                # Fields sent first are validated now, so a bad request is refused before its image is read
+                if "client_id" in fields:
+                    form = parse_upload_form(fields)
+                filename, content_type = value
+                # Validate file type
+                if content_type not in ["image/png", "image/jpeg", "image/jpg"]:
+                    raise HTTPException(status_code=400, detail="Invalid file type. Only PNG and JPEG are supported.")
+                unique_filename = get_unique_filename(filename)
+                partial_path = UPLOAD_DIR / f"{unique_filename}.part"
+                continue
+
+            # A piece of the file: enforce the size limit and hash it as it arrives
+            size += len(value)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=400, detail="File too large. Max size is 10MB.")
+            hasher.update(value)
+            if buffer is not None:
+                await buffer.write(value)
+            if dimensions is None or size <= memory_max:
+                held.append(value)
+            else:
+                held.clear()
+            if dimensions is not None:
+                continue
+
+            # Only the header is parsed here, the pixels are decoded later by the pipeline
+            dimensions = read_image_size(b"".join(held))
+            if dimensions is None:
+                if size >= UPLOAD_HEADER_MAX:
+                    raise HTTPException(status_code=400, detail="Could not read the image.")
+                continue
+            # Shed load before anything is written to disk. A refused upload is still read
+            # to the end, without keeping it, in case its result is cached. Without the
+            # fields there is nothing to decide on yet, so the image is kept until they arrive.
+            if form is not None:
+                long_edge, pixels = trace_size(form.detail, *dimensions)
+                try:
+                    reservation, estimate = admission.admit(pixels, form.priority)
+                    admitted = (pixels, form.priority)
+                except HTTPException as e:
+                    rejection = e
+            if rejection is None:
+                buffer = await aiofiles.open(partial_path, "wb")
+                for chunk in held:
+                    await buffer.write(chunk)
+            if size > memory_max:
+                held.clear()
+
+        if not file_seen:
+            raise HTTPException(status_code=400, detail="Send one image, in the form field 'file'.")
+        if dimensions is None:
+            raise HTTPException(status_code=400, detail="Could not read the image.")
+        if buffer is not None:
+            await buffer.close()
+        contents = b"".join(held) if size <= memory_max else None
+        del held
+
+        # Fields sent after the file complete the form; admit against the final one unless the
+        # early decision still holds (an early refusal stands, the image wasn't kept)
+        if form is None or late_fields:
+            form = parse_upload_form(fields)
+        logging.info(f"Received upload request - client_id: {form.client_id}, "
+                     f"stitch_density: {form.stitch_density}, stitch_type: {form.stitch_type}")
+        long_edge, pixels = trace_size(form.detail, *dimensions)
+        if rejection is None and admitted != (pixels, form.priority):
+            admission.release(reservation)
+            reservation = None
+            try:
+                reservation, estimate = admission.admit(pixels, form.priority)
+            except HTTPException as e:
+                rejection = e
 
         # Prepare settings
-        settings = {
-            "stitch_density": stitch_density,
-            "stitch_type": stitch_type
-        }
-
-        logging.info(f"File saved to {upload_path}, starting digitization with settings: {settings}")
+        settings = form.model_dump(exclude={"client_id", "priority"})
+        client_id, priority = form.client_id, form.priority
+        content_hash = hasher.hexdigest()
+        cache_key = get_cache_key(content_hash, settings)
+        tenant = get_tenant(client_id, x_api_key)
+
+        # Same image with the same settings: hand out the existing DST without running the pipeline
+        output_filename = unique_filename.split('.')[0] + ".dst"
+        preview_path = PROCESSED_DIR / f"{Path(unique_filename).stem}_processed.svg"
+        if result_cache.get(cache_key, OUTPUT_DIR / output_filename, preview_path):
+            supersede_client_jobs(client_id, priority)
+            job = job_store.create(client_id, "", output_filename, settings, lane=priority, tenant=tenant,
+                                   cache_key=cache_key, state="done")
+            logging.info(f"Cache hit for upload from {client_id}, job {job['id']}")
+            await manager.send_message(client_id, "Digitization complete.", job["id"])
+            return UploadResponse(
+                filename=output_filename,
+                download_url=f"/download/{output_filename}",
+                message="Embroidery file created from cache.",
+                job_id=job["id"],
+                estimated_start=job["created_at"],
+                estimated_completion=job["created_at"]
+            )
+        if rejection is not None:
+            raise rejection
+        supersede_client_jobs(client_id, priority)
+
+        # Keep the file
+        upload_path = UPLOAD_DIR / unique_filename
+        await aiofiles.os.replace(partial_path, upload_path)
 
-        # Start digitization in background
-        background_tasks.add_task(digitize_image, client_id, upload_path, settings)
+        # Queue the digitization; the dispatcher picks it up from the job store
+        job = job_store.create(client_id, upload_path, output_filename, settings,
+                               lane=priority, tenant=tenant, pixels=pixels,
+                               cache_key=cache_key, content_hash=content_hash, long_edge=long_edge)
+        if contents is not None:
+            upload_buffers.put(job["id"], contents)
+        dispatcher.notify()
+        logging.info(f"File saved to {upload_path}, queued job {job['id']} with settings: {settings}")
 
         # Generate download URL
-        download_url = f"/download/{unique_filename.split('.')[0]}.dst"
+        download_url = f"/download/{output_filename}"
 
         return UploadResponse(
-            filename=unique_filename.split('.')[0] + ".dst",
+            filename=output_filename,
             download_url=download_url,
-            message="Embroidery file is being created. Check updates via WebSocket."
+            message="Embroidery file is being created. Check updates via WebSocket.",
+            job_id=job["id"],
+            **estimate
         )
 
+    except (HTTPException, RequestValidationError):
+        raise
     except Exception as e:
         logging.error(f"Error in upload_image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # The job is in the store now, or there won't be one
+        admission.release(reservation)
+        if buffer is not None:
+            await buffer.close()
+        if partial_path is not None:
+            # Refused, failed or served from cache: the streamed file isn't needed
+            await asyncio.to_thread(partial_path.unlink, missing_ok=True)
+
+@app.get("/ready")
+async def readiness():
+    """
+    Readiness probe: 503 while the node is saturated, so a load balancer can route around it.
+    """
+    load = admission.load()
+    ready = load["saturation"] < READY_SATURATION
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "saturation": round(load["saturation"], 3),
+            "queue_depth": load["queue_depth"],
+            "running": load["running"],
+            "inflight_pixels": load["inflight_pixels"],
+        }
+    )
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """
+    Endpoint to query the state of a digitization job.
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    return JobResponse(
+        job_id=job["id"],
+        state=job["state"],
+        filename=job["output_filename"],
+        download_url=f"/download/{job['output_filename']}" if job["state"] == "done" else None,
+        error=job["error"],
+        created_at=job["created_at"],
+        started_at=job["started_at"],
+        finished_at=job["finished_at"]
+    )
+
+@app.delete("/jobs/{job_id}", response_model=JobResponse)
+async def delete_job(job_id: str):
+    """
+    Endpoint to cancel a queued or running digitization job.
+    """
+    if job_store.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if not cancel_job(job_id):
+        raise HTTPException(status_code=409, detail="Job has already finished.")
+    return await get_job(job_id)
 
 @app.get("/download/{filename}", response_class=FileResponse)
 async def download_file(filename: str):
@@ -467,4 +3297,10 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             data = await websocket.receive_text()
             await websocket.send_text(f"Message received: {data}")
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
\ No newline at end of file
+        # A stale socket closing after the client reconnected says nothing about its jobs
+        if not manager.disconnect(client_id, websocket):
+            return
+        # Nobody is waiting for these results any more
+        cancelled = cancel_client_jobs(client_id)
+        if cancelled:
+            logging.info(f"Cancelled {cancelled} jobs of disconnected client {client_id}")
\ No newline at end of file
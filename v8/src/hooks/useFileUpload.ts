@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useAuth } from './useAuth';
 import axios from 'axios';
 import { v4 as uuidv4 } from 'uuid';
@@ -20,6 +20,11 @@ export function useFileUpload() {
   const [downloadUrl, setDownloadUrl] = useState<string | null>(null);
   const [clientId] = useState(uuidv4());
   const { user } = useAuth();
+  // Jobs of earlier uploads: a new upload supersedes them, and their last messages (such as
+  // "Digitization cancelled.") must not end the current one
+  const staleJobs = useRef(new Set<string>());
+  const currentJob = useRef<string | null>(null);
+  const uploadCount = useRef(0);
 
   useEffect(() => {
     const ws = new WebSocket(`${import.meta.env.VITE_API_URL.replace('http', 'ws')}/ws/${clientId}`);
@@ -29,10 +34,25 @@ export function useFileUpload() {
     };
 
     ws.onmessage = (event) => {
-      const message = event.data;
+      // Job progress comes as {job_id, message}; anything else is plain text
+      let message: string = event.data;
+      let jobId: string | null = null;
+      try {
+        const data = JSON.parse(event.data);
+        message = data.message;
+        jobId = data.job_id;
+      } catch {
+        // Not about a job
+      }
+      if (jobId && staleJobs.current.has(jobId)) {
+        return;
+      }
       setMessages((prev) => [...prev, message]);
       
-      if (message === 'Digitization complete.') {
+      if (message === 'Digitization complete.' || message === 'Digitization cancelled.') {
+        setProcessing(false);
+      } else if (message.startsWith('Error during digitization')) {
+        setError(message);
         setProcessing(false);
       }
     };
@@ -48,6 +68,12 @@ export function useFileUpload() {
       return;
     }
 
+    if (currentJob.current) {
+      staleJobs.current.add(currentJob.current);
+      currentJob.current = null;
+    }
+    const upload = ++uploadCount.current;
+
     setSelectedFile(file);
     setError(null);
     setMessages([]);
@@ -55,12 +81,14 @@ export function useFileUpload() {
     setDownloadUrl(null);
 
     const formData = new FormData();
-    formData.append('file', file);
     formData.append('client_id', clientId);
     
     // Only send the parameters that the backend expects
     formData.append('stitch_density', Math.round(settings.stitchDensity).toString());
     formData.append('stitch_type', settings.stitchType);
+    formData.append('color_mode', settings.colorMode);
+    // The image goes last, so the server can accept or refuse it before storing any of it
+    formData.append('file', file);
 
     try {
       const response = await axios.post(`${import.meta.env.VITE_API_URL}/upload/`, formData, {
@@ -69,8 +97,17 @@ export function useFileUpload() {
         },
       });
 
+      if (upload !== uploadCount.current) {
+        // Another upload started meanwhile and superseded this one
+        staleJobs.current.add(response.data.job_id);
+        return;
+      }
+      currentJob.current = response.data.job_id;
       setDownloadUrl(response.data.download_url);
     } catch (err) {
+      if (upload !== uploadCount.current) {
+        return;
+      }
       console.error('Upload error:', err);
       setError(err instanceof Error ? err.message : 'Failed to upload file');
       setProcessing(false);